@@ -0,0 +1,502 @@
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import mimetypes
+import os
+import secrets
+from http import HTTPStatus
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs, unquote
+from game import KeyCode, Game, DungeonPool, parse_seed
+from leaderboard import Leaderboard, dots
+from save_writer import SaveWriter
+from session_store import GameSessions, CookieSessions
+
+# web.py 와 같은 route 를 asyncio 하나로 처리하는 서버 (thread 대신 세션마다 task 하나)
+# ex) python async_web.py --port 80
+
+key_map = {'38': KeyCode.up, '40': KeyCode.down, '39': KeyCode.right, '37': KeyCode.left}
+
+static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+logger = logging.getLogger(__name__)
+
+
+class Request:
+    def __init__(self, method, path, headers, body):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+        cookie = SimpleCookie(headers.get('cookie', ''))
+        self.cookies = {k: v.value for k, v in cookie.items()}
+
+    @property
+    def form(self):
+        return {k: v[0] for k, v in parse_qs(self.body.decode()).items()}
+
+
+class RequestError(Exception):
+    # 요청을 읽을 수 없을 때 보낼 status, 응답 후 연결을 닫음
+    def __init__(self, status):
+        super().__init__(status.phrase)
+        self.status = status
+
+
+class Response:
+    def __init__(self, body=b'', status=HTTPStatus.OK, content_type='text/html; charset=utf-8'):
+        self.body = body if isinstance(body, bytes) else body.encode()
+        self.status = status
+        self.headers = {'Content-Type': content_type}
+
+    @classmethod
+    def json(cls, data):
+        return cls(json.dumps(data), content_type='application/json')
+
+    def encode(self, keep_alive):
+        lines = ['HTTP/1.1 {} {}'.format(self.status.value, self.status.phrase)]
+        for k, v in self.headers.items():
+            lines.append('{}: {}'.format(k, v))
+        lines.append('Content-Length: {}'.format(len(self.body)))
+        lines.append('Connection: {}'.format('keep-alive' if keep_alive else 'close'))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode() + self.body
+
+
+class GameSession:
+    # 게임 하나를 task 하나가 순서대로 진행, 요청은 (key, future) 로 queue 에 넣음
+    def __init__(self, game):
+        self.game = game
+        self.queue = asyncio.Queue()
+        self.task = None
+        # Game.turn 에서 난 예외, generator 가 끝났으므로 더 진행할 수 없음
+        self.failed = None
+
+    def start(self):
+        context = self.game.turn(delta=True)
+        frame = context.send(None)
+        self.task = asyncio.ensure_future(self._run(context))
+        return frame
+
+    async def _run(self, context):
+        while True:
+            key, future = await self.queue.get()
+            if key is None:
+                # 세션 종료
+                break
+
+            if key is KeyCode.invalid:
+                # /login 재접속
+                try:
+                    future.set_result(self.game.render_delta(full=True))
+                except Exception as e:
+                    future.set_exception(e)
+                continue
+
+            try:
+                frame = context.send(key)
+            except StopIteration:
+                # future 에는 StopIteration 을 넣을 수 없음
+                self.failed = RuntimeError('game loop of {} has ended'.format(self.game.user_name))
+            except Exception as e:
+                self.failed = e
+            else:
+                future.set_result(frame)
+                continue
+
+            # 기다리는 요청은 모두 실패로 끝내고 task 종료
+            future.set_exception(self.failed)
+            while not self.queue.empty():
+                _, future = self.queue.get_nowait()
+                if future is not None:
+                    future.set_exception(self.failed)
+            break
+
+    def send(self, key):
+        future = asyncio.get_running_loop().create_future()
+        if self.failed is not None:
+            future.set_exception(self.failed)
+        else:
+            self.queue.put_nowait((key, future))
+        return future
+
+    def resync(self):
+        return self.send(KeyCode.invalid)
+
+    # GameSessions 가 파일로 내릴 때 사용
+    # 처리할 요청이 남아 있으면 내리지 않음 (요청은 get 과 같은 틈에 queue 에 들어감)
+    def try_lock(self):
+        return self.queue.empty()
+
+    def unlock(self):
+        pass
+
+    def close(self):
+        self.queue.put_nowait((None, None))
+
+
+class RankCache:
+    # web.MySQLCache 와 같이 refresh_tick 초마다 DB 에서 다시 읽음
+    def __init__(self, connect, refresh_tick=5):
+        self.connect = connect
+        self.refresh_tick = refresh_tick
+        self.last_access_time = datetime.datetime.min
+        self.result = None
+        # 다시 읽은 결과가 바뀔 때만 증가 (Leaderboard.version 과 같음)
+        self.version = 0
+
+    def get(self):
+        now = datetime.datetime.now()
+
+        if (now - self.last_access_time).seconds > self.refresh_tick:
+            connection = self.connect()
+            try:
+                cursor = connection.cursor()
+                cursor.execute('SELECT user_name, score FROM users ORDER BY score, last_login DESC LIMIT 10')
+                result = [[dots(i[0], 8), i[1]] for i in cursor.fetchall()]
+                cursor.close()
+            finally:
+                connection.close()
+
+            if result != self.result:
+                self.result = result
+                self.version += 1
+            self.last_access_time = now
+
+        return self.result
+
+    def top(self):
+        rank = self.get()
+        return self.version, rank
+
+
+class GameHost:
+    # user_name -> GameSession, 게임 생성/진행/종료 (shard.py 의 worker 도 사용)
+    def __init__(self, server_data, dungeon_pool=None, save_writer=None, spill_dir=None, leaderboard=None):
+        self.server_data = server_data
+        self.dungeon_pool = dungeon_pool
+        self.save_writer = save_writer
+        # 있으면 기록을 leaderboard 가 받아서 save_writer 로 전달
+        self.leaderboard = leaderboard
+        if spill_dir is not None:
+            # 입력이 없는 게임은 파일로 내렸다가 다음 요청 때 다시 불러옴
+            self.game_session = GameSessions(spill_dir, self._load_game, GameSession, **server_data['session'])
+        else:
+            self.game_session = dict()
+
+    def _load_game(self, data):
+        return Game.load(data, self.server_data, self.save_callback, self.dungeon_pool)
+
+    async def evict_idle_sessions(self):
+        # SessionStore 의 thread 대신 event loop 에서 주기적으로 실행
+        while True:
+            await asyncio.sleep(self.game_session.interval)
+            self.game_session.evict_idle()
+
+    def save_callback(self, player_name, player_turn_count, game_data):
+        if self.leaderboard is not None:
+            self.leaderboard.put(player_name, player_turn_count, game_data)
+        elif self.save_writer is not None:
+            self.save_writer.put(player_name, player_turn_count, game_data)
+
+    async def start_game(self, user_name, random_seed):
+        # 맵 생성은 DungeonPool 이 비어 있으면 오래 걸리므로 thread 에서
+        loop = asyncio.get_running_loop()
+        game = await loop.run_in_executor(
+            None, Game, self.server_data, user_name, self.save_callback, random_seed, self.dungeon_pool
+        )
+        game_session = GameSession(game)
+        frame = game_session.start()
+        await self.end_game(user_name)
+        self.game_session[user_name] = game_session
+        return frame
+
+    async def resync(self, user_name):
+        # 게임이 없으면 None
+        return await self._send(user_name, KeyCode.invalid)
+
+    async def command(self, user_name, key):
+        return await self._send(user_name, key)
+
+    async def _send(self, user_name, key):
+        game_session = self.game_session.get(user_name)
+        if game_session is None:
+            return None
+        try:
+            return await game_session.send(key)
+        except Exception:
+            # 진행할 수 없는 게임은 버림, 다음 /login 에서 새 게임
+            logger.exception('game of %s failed', user_name)
+            if game_session.failed is not None and self.game_session.get(user_name) is game_session:
+                self.game_session.pop(user_name)
+            return None
+
+    async def end_game(self, user_name):
+        game_session = self.game_session.pop(user_name, None)
+        if game_session is not None:
+            game_session.close()
+
+
+class AsyncGameServer:
+    session_cookie = 'session'
+    # form 은 몇 byte 뿐이므로 body 크기를 제한
+    max_body = 4096
+    # keep-alive 연결에서 다음 요청 head 를 기다리는 시간, body 를 읽는 시간 (초)
+    idle_timeout = 60
+    read_timeout = 10
+
+    def __init__(self, host, rank_cache=None, session_ttl=86400):
+        # host: GameHost 또는 같은 method 를 가진 shard.ShardRouter
+        # rank_cache: RankCache 또는 Leaderboard
+        self.host = host
+        self.rank_cache = rank_cache
+        # 서버를 다시 시작하면 ETag 도 바뀌도록
+        self.rank_tag = secrets.token_hex(4)
+        # 쿠키의 session id -> flask session 과 같은 dict (web.ServerSessionInterface 와 같음)
+        self.sessions = CookieSessions(session_ttl)
+        self._rank_future = None
+
+    async def handle_connection(self, reader, writer):
+        # HTTP/1.1 keep-alive, 연결이 닫힐 때까지 요청을 순서대로 처리
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except RequestError as e:
+                    writer.write(Response('', e.status).encode(False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                session_id = request.cookies.get(self.session_cookie)
+                session = self.sessions.get(session_id)
+                if session is None:
+                    session = dict()
+
+                try:
+                    response = await self.dispatch(request, session)
+                except Exception:
+                    response = Response('', HTTPStatus.INTERNAL_SERVER_ERROR)
+                    keep_alive = False
+
+                # 세션에 값이 생겼을 때만 저장하고 쿠키 발급
+                if session and session_id not in self.sessions:
+                    session_id = secrets.token_urlsafe(16)
+                    self.sessions.put(session_id, session)
+                    response.headers['Set-Cookie'] = '{}={}; Path=/; HttpOnly'.format(self.session_cookie, session_id)
+
+                writer.write(response.encode(keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError,
+                asyncio.TimeoutError, asyncio.CancelledError):
+            # 시간 안에 요청을 보내지 않거나 종료할 때 취소된 연결은 조용히 닫음
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        # head 크기는 reader 의 limit (64 KiB) 으로 제한
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.idle_timeout)
+        except asyncio.IncompleteReadError:
+            return None
+
+        lines = head.decode('latin-1').split('\r\n')
+        method, path, _ = lines[0].split(' ', 2)
+        headers = dict()
+        for line in lines[1:]:
+            if ':' in line:
+                k, v = line.split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+
+        # chunked 등 transfer-encoding 은 지원하지 않음 (Content-Length 와 다르게 해석하면 요청 경계가 어긋남)
+        if 'transfer-encoding' in headers:
+            raise RequestError(HTTPStatus.NOT_IMPLEMENTED)
+        length = headers.get('content-length', '0')
+        if not length.isdigit():
+            raise RequestError(HTTPStatus.BAD_REQUEST)
+        length = int(length)
+        if length > self.max_body:
+            raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body = await asyncio.wait_for(reader.readexactly(length), self.read_timeout) if length else b''
+        return Request(method, unquote(path.split('?', 1)[0]), headers, body)
+
+    async def dispatch(self, request, session):
+        path = request.path
+        if path == '/':
+            return self.send_static_file('index.html')
+        if path == '/favicon.ico':
+            return self.send_static_file('favicon.png')
+        if path.startswith('/static/'):
+            return self.send_static_file(path[len('/static/'):])
+        if path.startswith('/seed/'):
+            return await self.take_random_seed(session, path[len('/seed/'):])
+        if request.method == 'POST':
+            if path == '/login':
+                return await self.login(session, request.form.get('user_name'))
+            if path == '/command':
+                return await self.command(session, request.form.get('direction'))
+            if path == '/high_rank':
+                return await self.high_rank(request)
+        return Response('', HTTPStatus.NOT_FOUND)
+
+    def send_static_file(self, path):
+        # static 밖의 파일은 보내지 않음
+        file_path = os.path.normpath(os.path.join(static_dir, path))
+        if os.path.dirname(file_path) != static_dir or not os.path.isfile(file_path):
+            return Response('', HTTPStatus.NOT_FOUND)
+
+        with open(file_path, 'rb') as f:
+            body = f.read()
+        content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        return Response(body, content_type=content_type)
+
+    async def take_random_seed(self, session, seed):
+        try:
+            session['random_seed'] = parse_seed(seed)
+            if 'user_name' in session:
+                await self.host.end_game(session.pop('user_name'))
+        except ValueError:
+            session['random_seed'] = None
+
+        return self.send_static_file('index.html')
+
+    async def login(self, session, user_name):
+        if 'user_name' in session:
+            if session['user_name'] == user_name:
+                frame = await self.host.resync(user_name)
+                if frame is not None:
+                    return self.frame_response(frame)
+            else:
+                await self.host.end_game(session.pop('user_name'))
+
+        frame = await self.host.start_game(user_name, session.get('random_seed', None))
+        session['user_name'] = user_name
+        return self.frame_response(frame)
+
+    async def command(self, session, raw_dir):
+        key = key_map.get(raw_dir, KeyCode.invalid)
+        if key is KeyCode.invalid or 'user_name' not in session:
+            return Response('')
+
+        frame = await self.host.command(session['user_name'], key)
+        if frame is None:
+            return Response('')
+        return self.frame_response(frame)
+
+    @staticmethod
+    def frame_response(frame):
+        # shard worker 는 JSON 으로 이미 바꾼 bytes 를 보냄
+        if isinstance(frame, bytes):
+            return Response(frame, content_type='application/json')
+        return Response.json(frame)
+
+    async def high_rank(self, request):
+        if self.rank_cache is None:
+            return Response.json({'rank': []})
+
+        if isinstance(self.rank_cache, Leaderboard):
+            version, rank = self.rank_cache.top()
+        else:
+            # 동시에 여러 요청이 와도 DB 조회는 한 번만
+            if self._rank_future is None:
+                loop = asyncio.get_running_loop()
+                self._rank_future = loop.run_in_executor(None, self.rank_cache.top)
+            try:
+                version, rank = await asyncio.shield(self._rank_future)
+            finally:
+                self._rank_future = None
+
+        # 상위 순위가 바뀌지 않았으면 304
+        etag = '"{}-{}"'.format(self.rank_tag, version)
+        if etag in [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]:
+            response = Response(status=HTTPStatus.NOT_MODIFIED)
+        else:
+            response = Response.json({'rank': rank})
+        response.headers['ETag'] = etag
+        return response
+
+
+def connector(server_data, sqlite_path=None):
+    # (DB connection 을 만드는 함수, SaveWriter dialect)
+    if sqlite_path is not None:
+        import sqlite3
+
+        connection = sqlite3.connect(sqlite_path)
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS users (user_name TEXT PRIMARY KEY, score INTEGER, map_data TEXT, '
+            'last_login TIMESTAMP DEFAULT CURRENT_TIMESTAMP)'
+        )
+        connection.commit()
+        connection.close()
+        return (lambda: sqlite3.connect(sqlite_path, timeout=10)), 'sqlite'
+
+    import pymysql
+
+    mysql_data = server_data['mysql']
+
+    def connect():
+        return pymysql.connect(
+            host=mysql_data['host'], port=mysql_data['port'], user=mysql_data['user'],
+            password=mysql_data['password'], db=mysql_data['database']
+        )
+    return connect, 'mysql'
+
+
+def start_game_host(server_data, connect, dialect, spill_dir='sessions', leaderboard=False):
+    dungeon_pool = DungeonPool(server_data)
+    if os.path.exists('dungeon_blobs.bin'):
+        dungeon_pool.preload('dungeon_blobs.bin')
+    dungeon_pool.start()
+
+    save_writer = SaveWriter(connect, dialect)
+    save_writer.start()
+
+    # shard worker 는 일부 사용자만 보므로 front 의 RankCache 를 사용
+    board = None
+    if leaderboard:
+        board = Leaderboard(save_writer)
+        board.load(connect)
+
+    return GameHost(server_data, dungeon_pool, save_writer, spill_dir, board)
+
+
+def stop_game_host(host):
+    host.save_writer.close(10)
+    host.dungeon_pool.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=80)
+    parser.add_argument('--data', default='game_data.json')
+    parser.add_argument('--sqlite', default=None, help='use a local SQLite file instead of MySQL')
+    args = parser.parse_args()
+
+    with open(args.data, 'r', encoding='utf-8') as f:
+        server_data = json.load(f)
+
+    connect, dialect = connector(server_data, args.sqlite)
+    host = start_game_host(server_data, connect, dialect, leaderboard=True)
+    server = AsyncGameServer(host, host.leaderboard, server_data['session']['spill_ttl'])
+
+    async def serve():
+        asyncio.ensure_future(host.evict_idle_sessions())
+        async with await asyncio.start_server(server.handle_connection, args.host, args.port) as s:
+            await s.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    finally:
+        stop_game_host(host)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import argparse
+import json
+import sys
+import time
+from multiprocessing import Pool
+from game import Game, write_blob
+
+# 이벤트용 seed 를 미리 검증하기 위해 여러 프로세스에서 던전을 생성하고 통계를 JSONL 로 출력
+# ex) python dungeon_batch.py -n 1000 --start 1 --blobs dungeon_blobs.bin > stats.jsonl
+
+game_data = None
+pack_layout = False
+
+
+def init_worker(data_path, with_blobs):
+    global game_data, pack_layout
+    with open(data_path, 'r', encoding='utf-8') as f:
+        game_data = json.load(f)
+    pack_layout = with_blobs
+
+
+def farm(seed):
+    start = time.perf_counter()
+    game = Game(game_data, 'batch', None, seed)
+    generation_time = time.perf_counter() - start
+
+    dungeon = game._dungeon
+    player = dungeon.get_player()
+    goal = dungeon.get_goal()
+    path = dungeon.find_path(player.x, player.y, goal.x, goal.y)
+    floors = len(dungeon.floor_cells())
+
+    stats = {
+        'seed': seed,
+        'floors': floors,
+        'rooms': dungeon.rooms,
+        'goal_path_length': len(path) if path is not None else None,
+        'monster_density': len(dungeon.monsters) / floors,
+        'generation_ms': round(generation_time * 1000, 3),
+    }
+    return stats, dungeon.layout.pack() if pack_layout else None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=100)
+    parser.add_argument('--start', type=int, default=0, help='first seed')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='default: number of cores')
+    parser.add_argument('--data', default='game_data.json')
+    parser.add_argument('--blobs', default=None, help='write packed layouts for DungeonPool.preload')
+    args = parser.parse_args()
+
+    blobs = open(args.blobs, 'wb') if args.blobs else None
+    seeds = range(args.start, args.start + args.count)
+
+    with Pool(args.workers, initializer=init_worker, initargs=(args.data, blobs is not None)) as pool:
+        for stats, blob in pool.imap_unordered(farm, seeds, chunksize=8):
+            sys.stdout.write(json.dumps(stats) + '\n')
+            sys.stdout.flush()
+            if blobs:
+                write_blob(blobs, blob)
+
+    if blobs:
+        blobs.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,69 @@ import math
 import pickle
 import enum
 import base64
+import io
+import itertools
+import logging
+import queue
+import threading
+import struct
+import zlib
+from array import array
+from collections import OrderedDict
+from heapq import heappush, heappop
+from operator import itemgetter
 from random import Random
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
 screen_width = 80
 screen_height = 50
+# 화면에서 던전이 그려지는 영역
+view_width = 80
+view_height = 40
 
+# 플레이어 한 번의 행동에 걸리는 시간
+TURN_TIME = 100
+
+
+# blocked 상태 (None / False / True) 를 byte 로 저장
+TILE_UNTOUCHED = 0
+TILE_FLOOR = 1
+TILE_WALL = 2
+
+_tile_code = {None: TILE_UNTOUCHED, False: TILE_FLOOR, True: TILE_WALL}
+
+# 길찾기: 8방향 (dx, dy, cost), 대각선은 3 / 직선은 2 로 거리 근사
+PATH_UNREACHABLE = 0xFFFFFFFF
+_path_neighbors = (
+    (0, -1, 2), (1, 0, 2), (0, 1, 2), (-1, 0, 2),
+    (1, -1, 3), (1, 1, 3), (-1, 1, 3), (-1, -1, 3),
+)
 
-class Tile:
-    def __init__(self, blocked=None):
-        self.blocked = blocked
-        self.light = 0
+
+def color_to_str(color):
+    if color == (0, 0, 0):
+        return ''
+    return ''.join(format(e, '02X') for e in color)
+
+
+def escape_brackets(text):
+    # jquery.terminal 의 $.terminal.escape_brackets 와 동일
+    return text.replace('[', '&#91;').replace(']', '&#93;')
+
+
+def build_palette(game_data):
+    # 게임 데이터와 UI 에서 쓰는 색상 문자열을 미리 만들어 둠
+    colors = [(0, 0, 0), (40, 40, 40), (60, 60, 60), (85, 85, 85), (170, 170, 170), (255, 255, 255), (85, 85, 255)]
+    for group in ('characters', 'monsters', 'items'):
+        for v in game_data[group].values():
+            colors.append(tuple(v['color']))
+    return {color: color_to_str(color) for color in colors}
 
 
 class Rect:
@@ -30,20 +83,22 @@ class GameObject:
         self.char = char
         self.color = color
         self.dungeon = dungeon
+        # 생성된 위치, layout.spawns 의 번호 또는 chunk 맵에서는 (chunk_x, chunk_y, 번호)
+        self.spawn_id = None
 
     def move(self, dx, dy):
         if self.dungeon.can_move(self.x + dx, self.y + dy):
-            self.x += dx
-            self.y += dy
+            self.dungeon.move_object(self, self.x + dx, self.y + dy)
             return True
         else:
             return False
 
     def draw(self):
-        self.game.draw_char(self.x, self.y, self.char, self.color)
+        self.dungeon.draw_char(self.x, self.y, self.char, self.color)
 
     def clear(self):
-        self.game.draw_char(self.x, self.y, ' ', self.color)
+        # 오브젝트 아래의 던전 타일을 다시 그림
+        self.dungeon.draw_tile(self.x, self.y)
 
 
 class Player(GameObject):
@@ -94,19 +149,18 @@ class Player(GameObject):
         x = self.x + dx
         y = self.y + dy
 
-        for game_object in self.dungeon.get_objects():
-            if game_object.x == x and game_object.y == y:
-                if type(game_object) is Monster:
-                    self.attack(game_object)
-                    break
-                elif type(game_object) is Item:
-                    game_object.pick_up(self)
-                    self.turn_count += 1
-                    break
-                elif type(game_object) is Goal:
-                    game_object.touch(self)
-                    self.turn_count += 1
-                    break
+        for game_object in self.dungeon.get_objects_at(x, y):
+            if type(game_object) is Monster:
+                self.attack(game_object)
+                break
+            elif type(game_object) is Item:
+                game_object.pick_up(self)
+                self.turn_count += 1
+                break
+            elif type(game_object) is Goal:
+                game_object.touch(self)
+                self.turn_count += 1
+                break
         else:
             if super().move(dx, dy):
                 self.turn_count += 1
@@ -118,13 +172,14 @@ class Player(GameObject):
             return (string[:length] + '..') if len(string) > length else string
 
         self.game.status_bar(
-            '{} - hp[{}] power[{}] defence[{}] sight[{}] turn[{}]'.format(
+            '{} - hp[{}] power[{}] defence[{}] sight[{}] turn[{}] depth[{}]'.format(
                 dots(self.name, 8),
                 self.hp,
                 self.power,
                 self.defence,
                 self.sight,
-                self.turn_count
+                self.turn_count,
+                self.game.depth + 1
             )
         )
 
@@ -139,6 +194,9 @@ class Monster(GameObject):
         self.defence = monster_data['defence']
         self.power = monster_data['power']
         self.name = monster_data['name']
+        # speed 2 는 플레이어 한 턴에 두 번, 0.5 는 두 턴에 한 번 행동 (없으면 플레이어와 같은 1)
+        self.speed = monster_data.get('speed', 1)
+        self.action_time = int(round(TURN_TIME / self.speed))
         super().__init__(game, x, y, icon_char, tuple(monster_data['color']), dungeon)
 
     def attack(self, target: Player):
@@ -162,13 +220,21 @@ class Monster(GameObject):
         return math.sqrt(dx ** 2 + dy ** 2)
 
     def _move_towards(self, game_object):
-        dx = game_object.x - self.x
-        dy = game_object.y - self.y
-        distance = self._distance_to(game_object)
-
-        dx = int(round(dx / distance))
-        dy = int(round(dy / distance))
-        self.move(dx, dy)
+        # 대상까지의 거리 field 를 따라 가장 가까워지는 빈 칸으로 이동
+        field = self.dungeon.distance_field(game_object.x, game_object.y, self.dungeon.path_limit)
+        best = field[self.dungeon._index(self.x, self.y)]
+        step = None
+
+        for dx, dy, _ in _path_neighbors:
+            x, y = self.x + dx, self.y + dy
+            if 0 <= x < self.dungeon.map_width and 0 <= y < self.dungeon.map_height:
+                distance = field[self.dungeon._index(x, y)]
+                if distance < best and self.dungeon.can_move(x, y):
+                    best = distance
+                    step = (dx, dy)
+
+        if step is not None:
+            self.move(*step)
 
     def take_turn(self):
         player = self.dungeon.get_player()
@@ -193,13 +259,21 @@ class Item(GameObject):
 
 
 class Goal(GameObject):
-    def __init__(self, game, x, y, dungeon):
-        super().__init__(game, x, y, 'G', (255, 255, 255), dungeon)
+    def __init__(self, game, x, y, dungeon, up=False):
+        # up 이면 위층으로 올라가는 계단
+        self.up = up
+        super().__init__(game, x, y, '<' if up else 'G', (255, 255, 255), dungeon)
 
     def touch(self, target):
-        self.game.save()
-        target.clear_dungeon()
-        self.dungeon.remove_object(self)
+        if self.up:
+            self.game.change_level(-1)
+        elif not self.game.is_last_level():
+            self.game.change_level(1)
+        else:
+            # 마지막 층의 탈출구
+            self.game.save()
+            target.clear_dungeon()
+            self.dungeon.remove_object(self)
 
 
 class KeyCode(enum.Enum):
@@ -212,70 +286,303 @@ class KeyCode(enum.Enum):
     esc = 4
 
 
+# save 의 오브젝트 종류 (DungeonLayout._kinds)
+_save_kinds = {Player: 'player', Monster: 'monster', Item: 'item', Goal: 'goal'}
+
+# 입력 기록에 남기는 키 (2 bit)
+_replay_keys = (KeyCode.up, KeyCode.right, KeyCode.down, KeyCode.left)
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    # 예전 pickle 형식 (Tile, dungeon_map), game 의 class 는 속성만 읽는 빈 class 로 바꿔서 읽음
+    _modules = ('builtins', 'copyreg', 'collections')
+    _classes = dict()
+
+    def find_class(self, module, name):
+        if module == 'game':
+            if name == 'KeyCode':
+                return KeyCode
+            if name not in self._classes:
+                self._classes[name] = type(name, (), dict())
+            return self._classes[name]
+        if module in self._modules:
+            return super().find_class(module, name)
+        # web.save_callback 같은 save_handler 는 Game.load 인자로 대체
+        return None
+
+
+class TurnScheduler:
+    def __init__(self):
+        self.now = 0
+        # (행동 시각, 순서, entity) heap
+        self._queue = list()
+        self._scheduled = set()
+
+    def __contains__(self, entity):
+        return entity in self._scheduled
+
+    def schedule(self, entity, time, order):
+        heappush(self._queue, (time, order, entity))
+        self._scheduled.add(entity)
+
+    def unschedule(self, entity):
+        # heap 에서는 pop_due 때 버려짐
+        self._scheduled.discard(entity)
+
+    def times(self):
+        # entity -> 다음 행동 시각 (pop_due 와 같이 heap 에서 가장 이른 것)
+        times = dict()
+        for time, _, entity in self._queue:
+            if entity in self._scheduled and time < times.get(entity, time + 1):
+                times[entity] = time
+        return times
+
+    def pop_due(self):
+        # 현재 시각까지 행동할 entity 를 하나씩 꺼냄, 없으면 None
+        while self._queue and self._queue[0][0] <= self.now:
+            time, order, entity = heappop(self._queue)
+            if entity in self._scheduled:
+                self._scheduled.discard(entity)
+                return time, order, entity
+        return None
+
+
 class Dungeon:
-    def __init__(self, game, game_data, object_list):
+    def __init__(self, game, game_data, object_list, width=None, height=None):
         self.object_list = object_list
-        self.map_width = game_data['dungeon']['width']
-        self.map_height = game_data['dungeon']['height']
+        # (x, y) -> 해당 칸의 오브젝트 list (object_list 순서 유지)
+        self.occupancy = dict()
+        # 종류별 registry (dict 는 삽입 순서를 유지하는 set 으로 사용)
+        self.player = None
+        self.monsters = dict()
+        self.items = dict()
+        self.goal = None
+        self._serial = 0
+        self.map_width = width or game_data['dungeon']['width']
+        self.map_height = height or game_data['dungeon']['height']
         self.max_features = game_data['dungeon']['features']
-        self.dungeon_map = [[Tile() for _ in range(self.map_width)] for _ in range(self.map_height)]
+        # 플레이어 주변 wake_radius 안의 몬스터만 턴을 진행
+        self.wake_radius = game_data['dungeon']['wake_radius']
+        # 몬스터 길찾기 field 를 계산할 최대 거리 (직선 1칸 = cost 2)
+        self.path_limit = game_data['dungeon']['chase_distance'] * 2
+        # (bucket_x, bucket_y) -> 해당 영역의 몬스터
+        self.bucket_size = game_data['dungeon']['bucket_size']
+        self.monster_buckets = dict()
+        # row-major 1차원 배열 (index = y * map_width + x)
+        self.blocked = bytearray(self.map_width * self.map_height)
+        self.light = array('I', [0]) * (self.map_width * self.map_height)
+        # 한 번이라도 시야에 들어온 칸
+        self.explored = bytearray(self.map_width * self.map_height)
+        # 현재 시야 및 마지막 draw 이후 상태가 바뀐 칸 (None 이면 전체를 그림)
+        self._visible = set()
+        self._dirty = None
         self.flag = 0
+        # set_block 마다 증가, 시야 캐시 키에 포함
+        self.version = 0
+        self._fov_key = None
+        self._fov_cache = OrderedDict()
+        self._field_key = None
+        self._field = None
+        self.scheduler = TurnScheduler()
+        self._frontier = None
+        self._frontier_pos = None
+        self.rooms = 0
+        self.layout = None
+        # 화면 (0, 0) 에 해당하는 던전 좌표
+        self.camera_x = 0
+        self.camera_y = 0
         self.game = game
 
+        for game_object in object_list:
+            self._occupy(game_object)
+            self._register(game_object)
+
+    def _index(self, x, y):
+        return y * self.map_width + x
+
+    def in_map(self, x, y):
+        return 0 <= x < self.map_width and 0 <= y < self.map_height
+
     def create_room(self, room):
         for x in range(room.x1 + 1, room.x2):
             for y in range(room.y1 + 1, room.y2):
-                self.dungeon_map[y][x].blocked = False
+                self.set_block(x, y, False)
 
     def create_h_tunnel(self, x1, x2, y):
         for x in range(min(x1, x2), max(x1, x2) + 1):
-            self.dungeon_map[y][x].blocked = False
+            self.set_block(x, y, False)
 
     def create_v_tunnel(self, y1, y2, x):
         for y in range(min(y1, y2), max(y1, y2) + 1):
-            self.dungeon_map[y][x].blocked = False
+            self.set_block(x, y, False)
 
     def is_block(self, x, y):
-        if self.map_width > x and self.map_height > y:
-            return self.dungeon_map[y][x].blocked in (True, None)
+        if self.in_map(x, y):
+            return self.blocked[self._index(x, y)] != TILE_FLOOR
         return True
 
     def can_make_tile(self, x, y):
-        return self.dungeon_map[y][x].blocked is None
+        return self.blocked[self._index(x, y)] == TILE_UNTOUCHED
 
     def set_block(self, x, y, is_block):
-        self.dungeon_map[y][x].blocked = is_block
+        i = self._index(x, y)
+        self.blocked[i] = _tile_code[is_block]
+        self.version += 1
+        if self._frontier is not None:
+            self._update_frontier(i)
 
     def can_move(self, x, y):
-        return not self.is_block(x, y) and not any([i.x == x and i.y == y for i in self.object_list])
+        return not self.is_block(x, y) and (x, y) not in self.occupancy
 
     def get_monsters(self):
-        return [i for i in self.object_list if isinstance(i, Monster)]
+        return list(self.monsters)
+
+    def get_active_monsters(self, x, y, radius):
+        # bucket 단위로 주변만 확인, 순서는 배치 순서
+        size = self.bucket_size
+        radius_squared = radius * radius
+        active = list()
+        for by in range((y - radius) // size, (y + radius) // size + 1):
+            for bx in range((x - radius) // size, (x + radius) // size + 1):
+                for monster in self.monster_buckets.get((bx, by), ()):
+                    if (monster.x - x) ** 2 + (monster.y - y) ** 2 <= radius_squared:
+                        active.append(monster)
+
+        active.sort(key=self.monsters.__getitem__)
+        return active
 
     def get_items(self):
-        return [i for i in self.object_list if isinstance(i, Item)]
+        return list(self.items)
 
     def get_objects(self):
         return self.object_list
 
+    def get_objects_at(self, x, y):
+        return self.occupancy.get((x, y), ())
+
     def get_player(self):
-        return [i for i in self.object_list if isinstance(i, Player)].pop()
+        return self.player
+
+    def get_goal(self):
+        return self.goal
+
+    def _occupy(self, game_object):
+        self.occupancy.setdefault((game_object.x, game_object.y), list()).append(game_object)
+
+    def _vacate(self, game_object):
+        key = (game_object.x, game_object.y)
+        objects = self.occupancy[key]
+        objects.remove(game_object)
+        if not objects:
+            del self.occupancy[key]
+
+    def _bucket(self, game_object):
+        return game_object.x // self.bucket_size, game_object.y // self.bucket_size
+
+    def _register(self, game_object):
+        if isinstance(game_object, Player):
+            self.player = game_object
+        elif isinstance(game_object, Monster):
+            self.monsters[game_object] = self._serial
+            self._serial += 1
+            self.monster_buckets.setdefault(self._bucket(game_object), dict())[game_object] = None
+        elif isinstance(game_object, Item):
+            self.items[game_object] = None
+        elif isinstance(game_object, Goal) and not game_object.up:
+            self.goal = game_object
+
+    def _unregister(self, game_object):
+        if game_object is self.player:
+            self.player = None
+        elif game_object is self.goal:
+            self.goal = None
+        elif game_object in self.monsters:
+            del self.monsters[game_object]
+            self._unbucket(game_object)
+            self.scheduler.unschedule(game_object)
+        else:
+            self.items.pop(game_object, None)
+
+    def _unbucket(self, game_object):
+        key = self._bucket(game_object)
+        bucket = self.monster_buckets[key]
+        del bucket[game_object]
+        if not bucket:
+            del self.monster_buckets[key]
+
+    def add_object(self, game_object):
+        self.object_list.append(game_object)
+        self._occupy(game_object)
+        self._register(game_object)
+
+    def move_object(self, game_object, x, y):
+        self._vacate(game_object)
+        is_monster = game_object in self.monsters
+        if is_monster:
+            self._unbucket(game_object)
+        game_object.x = x
+        game_object.y = y
+        self._occupy(game_object)
+        if is_monster:
+            self.monster_buckets.setdefault(self._bucket(game_object), dict())[game_object] = None
 
     def remove_object(self, game_object):
         self.object_list.remove(game_object)
+        self._vacate(game_object)
+        self._unregister(game_object)
+
+    def _draw_index(self, i, draw_char):
+        x, y = i % self.map_width - self.camera_x, i // self.map_width - self.camera_y
+        if not (0 <= x < view_width and 0 <= y < view_height):
+            return
+
+        if self.light[i] == self.flag:
+            if self.blocked[i] != TILE_FLOOR:
+                draw_char(x, y, '#', (85, 85, 85))
+            else:
+                draw_char(x, y, '.', (170, 170, 170))
+        elif self.explored[i]:
+            if self.blocked[i] != TILE_FLOOR:
+                draw_char(x, y, '#', (40, 40, 40))
+            else:
+                draw_char(x, y, '.', (60, 60, 60))
+        else:
+            draw_char(x, y, ' ', (0, 0, 0))
+
+    def draw_tile(self, x, y):
+        if self.in_map(x, y):
+            self._draw_index(self._index(x, y), self.game.draw_char)
+
+    def draw_char(self, x, y, char, color):
+        # 던전 좌표를 화면 좌표로 바꿔서 그림, 화면 밖이면 무시
+        x, y = x - self.camera_x, y - self.camera_y
+        if 0 <= x < view_width and 0 <= y < view_height:
+            self.game.draw_char(x, y, char, color)
+
+    def follow(self, game_object):
+        # 맵이 화면보다 크면 game_object 를 중심으로 카메라 이동
+        camera_x = min(max(game_object.x - view_width // 2, 0), max(self.map_width - view_width, 0))
+        camera_y = min(max(game_object.y - view_height // 2, 0), max(self.map_height - view_height, 0))
+        if (camera_x, camera_y) != (self.camera_x, self.camera_y):
+            self.camera_x, self.camera_y = camera_x, camera_y
+            self._dirty = None
 
     def draw(self):
-        for y, row in enumerate(self.dungeon_map):
-            for x in range(len(row)):
-                if self.is_light(x, y):
-                    if self.is_block(x, y):
-                        self.game.draw_char(x, y, '#', (85, 85, 85))
-                    elif self.is_block(x, y) is None:
-                        self.game.draw_char(x, y, '#', (85, 85, 85))
+        # 처음에는 화면 전체, 이후에는 시야/탐험 상태가 바뀐 칸만 그림
+        draw_char = self.game.draw_char
+
+        if self._dirty is None:
+            for y in range(view_height):
+                for x in range(view_width):
+                    if self.in_map(self.camera_x + x, self.camera_y + y):
+                        self._draw_index(self._index(self.camera_x + x, self.camera_y + y), draw_char)
                     else:
-                        self.game.draw_char(x, y, '.', (170, 170, 170))
-                else:
-                    self.game.draw_char(x, y, ' ', (0, 0, 0))
+                        draw_char(x, y, ' ', (0, 0, 0))
+        else:
+            for i in self._dirty:
+                self._draw_index(i, draw_char)
+
+        self._dirty = set()
 
     # Multipliers for transforming coordinates to other octants:
     mult = [
@@ -286,34 +593,55 @@ class Dungeon:
     ]
 
     def is_light(self, x, y):
-        return self.dungeon_map[y][x].light == self.flag
+        return self.light[self._index(x, y)] == self.flag
 
     def set_light(self, x, y):
-        if self.map_width > x and self.map_height > y:
-            self.dungeon_map[y][x].light = self.flag
+        if self.in_map(x, y):
+            self.light[self._index(x, y)] = self.flag
+
+    fov_cache_size = 16
+
+    # radius -> 8 octant 각각의 row 별 (ox, oy, l_slope, r_slope, in_radius) 목록
+    _fov_tables = dict()
 
-    def _cast_light(self, cx, cy, row, start, end, radius, xx, xy, yx, yy, id):
+    @classmethod
+    def _fov_table(cls, radius):
+        table = cls._fov_tables.get(radius)
+        if table is None:
+            radius_squared = radius * radius
+            table = list()
+            for oct in range(8):
+                xx, xy, yx, yy = cls.mult[0][oct], cls.mult[1][oct], cls.mult[2][oct], cls.mult[3][oct]
+                rows = list()
+                for j in range(1, radius + 1):
+                    dy = -j
+                    rows.append(tuple(
+                        (dx * xx + dy * xy, dx * yx + dy * yy,
+                         (dx - 0.5) / (dy + 0.5), (dx + 0.5) / (dy - 0.5),
+                         dx * dx + dy * dy < radius_squared)
+                        for dx in range(-j, 1)
+                    ))
+                table.append(rows)
+            cls._fov_tables[radius] = table
+        return table
+
+    def _cast_light(self, cx, cy, row, start, end, radius, rows, visible):
         if start < end:
             return
 
-        radius_squared = radius * radius
         for j in range(row, radius + 1):
-            dx, dy = -j - 1, -j
             blocked = False
 
-            while dx <= 0:
-                dx += 1
-
-                X, Y = cx + dx * xx + dy * xy, cy + dx * yx + dy * yy
+            for ox, oy, l_slope, r_slope, in_radius in rows[j - 1]:
+                X, Y = cx + ox, cy + oy
 
-                l_slope, r_slope = (dx - 0.5) / (dy + 0.5), (dx + 0.5) / (dy - 0.5)
                 if start < r_slope:
                     continue
                 elif end > l_slope:
                     break
                 else:
-                    if dx * dx + dy * dy < radius_squared:
-                        self.set_light(X, Y)
+                    if in_radius and 0 <= X < self.map_width and 0 <= Y < self.map_height:
+                        visible.append(self._index(X, Y))
 
                     if blocked:
                         if self.is_block(X, Y):
@@ -325,243 +653,808 @@ class Dungeon:
                     else:
                         if self.is_block(X, Y) and j < radius:
                             blocked = True
-                            self._cast_light(cx, cy, j + 1, start, l_slope,
-                                             radius, xx, xy, yx, yy, id + 1)
+                            self._cast_light(cx, cy, j + 1, start, l_slope, radius, rows, visible)
                             new_start = r_slope
 
             if blocked:
                 break
 
-    def do_fov(self, x, y, radius):
-        self.flag += 1
-        for oct in range(8):
-            self._cast_light(x, y, 1, 1.0, 0.0, radius,
-                             self.mult[0][oct], self.mult[1][oct],
-                             self.mult[2][oct], self.mult[3][oct], 0)
-
-    def make_tunnel(self, center_x, center_y, length, direction, random):
-        length = random.randint(2, length)
+    def _compute_fov(self, x, y, radius):
+        visible = list()
+        for rows in self._fov_table(radius):
+            self._cast_light(x, y, 1, 1.0, 0.0, radius, rows, visible)
 
-        if direction == KeyCode.up:
-            if center_x < 0 or center_x > self.map_width - 1:
-                return False
+        if numpy is not None:
+            return numpy.array(visible, dtype=numpy.intp)
+        return array('I', visible)
 
-            for y in range(center_y, center_y - length, -1):
-                if y < 0 or y > self.map_height - 1:
-                    return False
+    def do_fov(self, x, y, radius):
+        key = (x, y, radius, self.version)
+        if key == self._fov_key:
+            return
 
-                if not self.can_make_tile(center_x, y):
-                    return False
+        visible = self._fov_cache.get(key)
+        if visible is None:
+            visible = self._compute_fov(x, y, radius)
+            self._fov_cache[key] = visible
+            if len(self._fov_cache) > self.fov_cache_size:
+                self._fov_cache.popitem(last=False)
+        else:
+            self._fov_cache.move_to_end(key)
 
-            for y in range(center_y, center_y - length, -1):
-                self.set_block(center_x, y, False)
+        self.flag += 1
+        if numpy is not None:
+            numpy.frombuffer(self.light, dtype=numpy.uint32)[visible] = self.flag
+        else:
+            light = self.light
+            flag = self.flag
+            for i in visible:
+                light[i] = flag
+
+        visible = set(visible.tolist())
+        explored = self.explored
+        for i in visible - self._visible:
+            explored[i] = 1
+        if self._dirty is not None:
+            self._dirty |= visible ^ self._visible
+        self._visible = visible
+
+        self._fov_key = key
+
+    def distance_field(self, x, y, limit=None):
+        # (x, y) 에서 바닥 칸까지의 거리 (Dijkstra), 같은 턴의 몬스터들이 공유
+        # limit 이 있으면 그 거리 이상은 탐색하지 않음
+        key = (x, y, limit, self.version)
+        if key == self._field_key:
+            return self._field
+
+        width, height = self.map_width, self.map_height
+        blocked = self.blocked
+        field = array('I', [PATH_UNREACHABLE]) * (width * height)
+
+        start = self._index(x, y)
+        field[start] = 0
+        heap = [(0, start)]
+        while heap:
+            distance, i = heappop(heap)
+            if distance > field[i]:
+                continue
+            if limit is not None and distance >= limit:
+                continue
+
+            cx, cy = i % width, i // width
+            for dx, dy, cost in _path_neighbors:
+                nx, ny = cx + dx, cy + dy
+                if 0 <= nx < width and 0 <= ny < height:
+                    j = ny * width + nx
+                    if blocked[j] == TILE_FLOOR and distance + cost < field[j]:
+                        field[j] = distance + cost
+                        heappush(heap, (distance + cost, j))
+
+        self._field_key = key
+        self._field = field
+        return field
+
+    def find_path(self, x1, y1, x2, y2):
+        # A*, (x1, y1) 다음 칸부터 (x2, y2) 까지의 좌표 list, 길이 없으면 None
+        width, height = self.map_width, self.map_height
+        blocked = self.blocked
+
+        def heuristic(i):
+            dx, dy = abs(i % width - x2), abs(i // width - y2)
+            return 2 * max(dx, dy) + min(dx, dy)
+
+        start, goal = self._index(x1, y1), self._index(x2, y2)
+        cost = array('I', [PATH_UNREACHABLE]) * (width * height)
+        came_from = dict()
+
+        cost[start] = 0
+        heap = [(heuristic(start), 0, start)]
+        while heap:
+            _, distance, i = heappop(heap)
+            if i == goal:
+                path = list()
+                while i != start:
+                    path.append((i % width, i // width))
+                    i = came_from[i]
+                path.reverse()
+                return path
+
+            if distance > cost[i]:
+                continue
+
+            cx, cy = i % width, i // width
+            for dx, dy, step_cost in _path_neighbors:
+                nx, ny = cx + dx, cy + dy
+                if 0 <= nx < width and 0 <= ny < height:
+                    j = ny * width + nx
+                    if (blocked[j] == TILE_FLOOR or j == goal) and distance + step_cost < cost[j]:
+                        cost[j] = distance + step_cost
+                        came_from[j] = i
+                        heappush(heap, (distance + step_cost + heuristic(j), distance + step_cost, j))
+
+        return None
+
+    def is_region_untouched(self, x1, y1, x2, y2):
+        # (x1, y1) ~ (x2, y2) (양 끝 포함) 가 맵 안이고 아직 만들지 않은 칸인지 행 단위로 확인
+        if not (0 <= x1 <= x2 < self.map_width and 0 <= y1 <= y2 < self.map_height):
+            return False
 
-        elif direction == KeyCode.right:
-            if center_y < 0 or center_y > self.map_height - 1:
+        width = x2 - x1 + 1
+        for y in range(y1, y2 + 1):
+            start = y * self.map_width + x1
+            if self.blocked.count(TILE_UNTOUCHED, start, start + width) != width:
                 return False
+        return True
 
-            for y in range(center_x, center_x + length):
-                if 0 > y or y > self.map_height - 1:
-                    return False
-
-                if not self.can_make_tile(y, center_y):
-                    return False
+    def fill_region(self, x1, y1, x2, y2, is_block):
+        width = x2 - x1 + 1
+        row = bytes([_tile_code[is_block]]) * width
+        for y in range(y1, y2 + 1):
+            start = y * self.map_width + x1
+            self.blocked[start:start + width] = row
+        self.version += 1
+
+        if self._frontier is not None:
+            self._refresh_frontier((x, y) for y in range(y1 - 1, y2 + 2) for x in range(x1 - 1, x2 + 2))
+
+    def stamp_room(self, x1, y1, x2, y2):
+        # 테두리는 벽, 안쪽은 바닥. is_region_untouched 로 확인한 영역에만 사용
+        width = x2 - x1 + 1
+        wall_row = bytes([TILE_WALL]) * width
+        room_row = bytes([TILE_WALL]) + bytes([TILE_FLOOR]) * (width - 2) + bytes([TILE_WALL])
+        for y in range(y1, y2 + 1):
+            start = y * self.map_width + x1
+            self.blocked[start:start + width] = wall_row if y in (y1, y2) else room_row
+        self.version += 1
+        self.rooms += 1
+
+        # 빈 영역에 찍었으므로 후보가 바뀔 수 있는 칸은 테두리 뿐
+        if self._frontier is not None:
+            self._refresh_frontier(itertools.chain(
+                ((x, y) for x in range(x1, x2 + 1) for y in (y1, y2)),
+                ((x, y) for y in range(y1 + 1, y2) for x in (x1, x2)),
+            ))
 
-            for y in range(center_x, center_x + length):
-                self.set_block(y, center_y, False)
+    def make_tunnel(self, center_x, center_y, length, direction, random):
+        length = random.randint(2, length)
 
+        if direction == KeyCode.up:
+            region = (center_x, center_y - length + 1, center_x, center_y)
+        elif direction == KeyCode.right:
+            region = (center_x, center_y, center_x + length - 1, center_y)
         elif direction == KeyCode.down:
-            if center_x < 0 or center_x > self.map_width - 1:
-                return False
-
-            for y in range(center_y, center_y + length):
-                if y < 0 or y > self.map_height - 1:
-                    return False
-
-                if not self.can_make_tile(center_x, y):
-                    return False
-
-            for y in range(center_y, center_y + length):
-                self.set_block(center_x, y, False)
-
+            region = (center_x, center_y, center_x, center_y + length - 1)
         elif direction == KeyCode.left:
-            if center_y < 0 or center_y > self.map_height - 1:
-                return False
-
-            for y in range(center_x, center_x - length, -1):
-                if y < 0 or y > self.map_height - 1:
-                    return False
-
-                if not self.can_make_tile(y, center_y):
-                    return False
+            region = (center_x - length + 1, center_y, center_x, center_y)
+        else:
+            return True
 
-            for y in range(center_x, center_x - length, -1):
-                self.set_block(y, center_y, False)
+        if not self.is_region_untouched(*region):
+            return False
 
+        self.fill_region(*region, False)
         return True
 
     def make_room(self, center_x, center_y, width, height, direction, random):
         room_width = random.randint(4, width)
         room_height = random.randint(4, height)
 
-        if direction == KeyCode.invalid:
-            return False
-
+        # 문 (center_x, center_y) 에서 direction 방향으로 방을 붙임
         if direction == KeyCode.up:
-            for y in range(center_y, center_y - room_height, -1):
-                if y < 0 or y > self.map_height - 1:
-                    return False
-
-                for x in range(center_x - room_width // 2, (center_x + (room_width + 1) // 2)):
-                    if x < 0 or x > self.map_width - 1:
-                        return False
-
-                    if not self.can_make_tile(x, y):
-                        return False
-
-            for y in range(center_y, center_y - room_height, -1):
-                for x in range(center_x - room_width // 2, (center_x + (room_width + 1) // 2)):
-                    if x == center_x - room_width // 2:
-                        self.set_block(x, y, True)
-                    elif x == center_x + (room_width - 1) // 2:
-                        self.set_block(x, y, True)
-                    elif y == center_y:
-                        self.set_block(x, y, True)
-                    elif y == center_y - room_height + 1:
-                        self.set_block(x, y, True)
-                    else:
-                        self.set_block(x, y, False)
-
+            x1, y1 = center_x - room_width // 2, center_y - room_height + 1
         elif direction == KeyCode.right:
-            for y in range(center_y - room_height // 2, center_y + (room_height + 1) // 2):
-                if y < 0 or y > self.map_height - 1:
-                    return False
-
-                for x in range(center_x, center_x + room_width):
-                    if x < 0 or x > self.map_width - 1:
-                        return False
-
-                    if not self.can_make_tile(x, y):
-                        return False
-
-            for y in range(center_y - room_height // 2, center_y + (room_height + 1) // 2):
-                for x in range(center_x, center_x + room_width):
-                    if x == center_x:
-                        self.set_block(x, y, True)
-                    elif x == center_x + (room_width - 1):
-                        self.set_block(x, y, True)
-                    elif y == center_y - room_height // 2:
-                        self.set_block(x, y, True)
-                    elif y == center_y + (room_height - 1) // 2:
-                        self.set_block(x, y, True)
-                    else:
-                        self.set_block(x, y, False)
-
+            x1, y1 = center_x, center_y - room_height // 2
         elif direction == KeyCode.down:
-            for y in range(center_y, center_y + room_height):
-                if y < 0 or y > self.map_height - 1:
-                    return False
-
-                for x in range(center_x - room_width // 2, center_x + (room_width + 1) // 2):
-                    if x < 0 or x > self.map_width - 1:
-                        return False
-
-                    if not self.can_make_tile(x, y):
-                        return False
-
-            for y in range(center_y, center_y + room_height):
-                for x in range(center_x - room_width // 2, center_x + (room_width + 1) // 2):
-                    if x == center_x - room_width // 2:
-                        self.set_block(x, y, True)
-                    elif x == center_x + (room_width - 1) // 2:
-                        self.set_block(x, y, True)
-                    elif y == center_y:
-                        self.set_block(x, y, True)
-                    elif y == center_y + (room_height - 1):
-                        self.set_block(x, y, True)
-                    else:
-                        self.set_block(x, y, False)
-
+            x1, y1 = center_x - room_width // 2, center_y
         elif direction == KeyCode.left:
-            for y in range(center_y - room_height // 2, center_y + (room_height + 1) // 2):
-                if y < 0 or y > self.map_height - 1:
-                    return False
-
-                for x in range(center_x, center_x - room_width, -1):
-                    if x < 0 or x > self.map_width - 1:
-                        return False
-
-                    if not self.can_make_tile(x, y):
-                        return False
-
-            for y in range(center_y - room_height // 2, center_y + (room_height + 1) // 2):
-                for x in range(center_x, center_x - room_width - 1, -1):
-                    if x == center_x:
-                        self.set_block(x, y, True)
-                    elif x == center_x - room_width:
-                        self.set_block(x, y, True)
-                    elif y == center_y - room_height // 2:
-                        self.set_block(x, y, True)
-                    elif y == center_y + (room_height - 1) // 2:
-                        self.set_block(x, y, True)
-                    else:
-                        self.set_block(x, y, False)
+            x1, y1 = center_x - room_width + 1, center_y - room_height // 2
+        else:
+            return False
+
+        x2, y2 = x1 + room_width - 1, y1 + room_height - 1
+        if not self.is_region_untouched(x1, y1, x2, y2):
+            return False
 
+        self.stamp_room(x1, y1, x2, y2)
         return True
 
+    def _check_frontier(self, x, y):
+        # (x, y) 가 후보 (바닥과 맞닿은 벽) 인지 확인해서 목록 갱신
+        width = self.map_width
+        if not (1 <= x <= width - 2 and 1 <= y <= self.map_height - 2):
+            return
+
+        blocked = self.blocked
+        frontier = self._frontier
+        frontier_pos = self._frontier_pos
+        i = y * width + x
+        is_candidate = blocked[i] != TILE_FLOOR and TILE_FLOOR in (
+            blocked[i - width], blocked[i + 1], blocked[i + width], blocked[i - 1])
+
+        if is_candidate and i not in frontier_pos:
+            frontier_pos[i] = len(frontier)
+            frontier.append(i)
+        elif not is_candidate and i in frontier_pos:
+            # 마지막 원소와 자리를 바꿔서 제거
+            pos = frontier_pos.pop(i)
+            last = frontier.pop()
+            if last != i:
+                frontier[pos] = last
+                frontier_pos[last] = pos
+
+    def _refresh_frontier(self, cells):
+        for x, y in cells:
+            self._check_frontier(x, y)
+
+    def carve_to_floor(self, x, y, dx, dy):
+        # (x, y) 부터 바닥을 만날 때까지 (dx, dy) 방향으로 통로를 뚫음
+        while self.in_map(x, y) and self.blocked[self._index(x, y)] != TILE_FLOOR:
+            self.set_block(x, y, False)
+            x, y = x + dx, y + dy
+
+    def floor_cells(self):
+        return [i for i, tile in enumerate(self.blocked) if tile == TILE_FLOOR]
+
+    def load_layout(self, layout):
+        self.blocked[:] = layout.blocked
+        self.rooms = layout.rooms
+        self.version += 1
+        self.layout = layout
+
+    def diff_layout(self):
+        # layout 에서 바뀐 부분만 남김, layout 은 seed 로 다시 만들 수 있음
+        alive = {game_object.spawn_id: game_object for game_object in self.object_list}
+        removed = list()
+        changed = dict()
+        for n, (kind, _, x, y) in enumerate(self.layout.spawns):
+            if kind == 'player':
+                continue
+            game_object = alive.get(n)
+            if game_object is None:
+                removed.append(n)
+            elif kind == 'monster' and (game_object.x, game_object.y, game_object.hp) != (x, y, game_object.max_hp):
+                changed[n] = (game_object.x, game_object.y, game_object.hp)
+
+        times = {game_object.spawn_id: time for game_object, time in self.scheduler.times().items()
+                 if game_object.spawn_id is not None}
+        return LevelDiff(self.layout.seed, removed, changed, zlib.compress(self.explored), self.scheduler.now, times)
+
+    def _update_frontier(self, i):
+        # i 와 상하좌우 칸
+        x, y = i % self.map_width, i // self.map_width
+        self._refresh_frontier(((x, y), (x, y - 1), (x + 1, y), (x, y + 1), (x - 1, y)))
+
     def generate_map(self, random):
         room_chance = 70
         current_features = 1
 
+        # 새 방/통로를 붙일 수 있는 벽 칸 목록 (set_block 때 갱신)
+        self._frontier = list()
+        self._frontier_pos = dict()
+
         self.make_room(self.map_width // 2, self.map_height // 2, 5, 5, KeyCode(random.randint(0, 3)), random)
 
         for _ in range(1000):
             if current_features >= self.max_features:
                 break
 
-            new_x = 0
-            x_mod = 0
-            new_y = 0
-            y_mod = 0
-
-            for _ in range(1000):
-                new_x = random.randint(1, self.map_width - 2)
-                new_y = random.randint(1, self.map_height - 2)
-                direction = KeyCode.invalid
-
-                if self.is_block(new_x, new_y):
-                    if self.is_block(new_x, new_y + 1) is False:
-                        x_mod = 0
-                        y_mod = -1
-                        direction = KeyCode.up
-                    elif self.is_block(new_x - 1, new_y) is False:
-                        x_mod = 1
-                        y_mod = 0
-                        direction = KeyCode.right
-                    elif self.is_block(new_x, new_y - 1) is False:
-                        x_mod = 0
-                        y_mod = 1
-                        direction = KeyCode.down
-                    elif self.is_block(new_x + 1, new_y) is False:
-                        x_mod = -1
-                        y_mod = 0
-                        direction = KeyCode.left
-
-                    if direction is not KeyCode.invalid:
-                        break
-
-            if direction is not KeyCode.invalid:
-                feature = random.randint(0, 100)
-
-                if feature <= room_chance:
-                    if self.make_room(new_x + x_mod, new_y + y_mod, 20, 20, direction, random):
-                        self.set_block(new_x, new_y, False)
-                        self.set_block(new_x + x_mod, new_y + y_mod, False)
-                elif feature > room_chance:
-                    if self.make_tunnel(new_x + x_mod, new_y + y_mod, 10, direction, random):
-                        self.set_block(new_x, new_y, False)
-
-                current_features += 1
+            if not self._frontier:
+                break
+
+            i = self._frontier[random.randrange(len(self._frontier))]
+            new_x, new_y = i % self.map_width, i // self.map_width
+
+            if self.is_block(new_x, new_y + 1) is False:
+                x_mod = 0
+                y_mod = -1
+                direction = KeyCode.up
+            elif self.is_block(new_x - 1, new_y) is False:
+                x_mod = 1
+                y_mod = 0
+                direction = KeyCode.right
+            elif self.is_block(new_x, new_y - 1) is False:
+                x_mod = 0
+                y_mod = 1
+                direction = KeyCode.down
+            else:
+                x_mod = -1
+                y_mod = 0
+                direction = KeyCode.left
+
+            feature = random.randint(0, 100)
+
+            if feature <= room_chance:
+                if self.make_room(new_x + x_mod, new_y + y_mod, 20, 20, direction, random):
+                    self.set_block(new_x, new_y, False)
+                    self.set_block(new_x + x_mod, new_y + y_mod, False)
+            elif feature > room_chance:
+                if self.make_tunnel(new_x + x_mod, new_y + y_mod, 10, direction, random):
+                    self.set_block(new_x, new_y, False)
+
+            current_features += 1
+
+        self._frontier = None
+        self._frontier_pos = None
+
+
+class ChunkedDungeon(Dungeon):
+    # 월드를 chunk_size 크기의 chunk 로 나누고 플레이어 주변 chunk 만 메모리에 유지
+    # (2 * radius + 1) ^ 2 개의 chunk 를 하나의 Dungeon 격자 (window) 로 사용
+    def __init__(self, game, game_data, object_list, seed):
+        self.game_data = game_data
+        self.seed = seed
+        self.chunk_size = game_data['chunk']['size']
+        self.chunk_radius = game_data['chunk']['radius']
+        span = (2 * self.chunk_radius + 1) * self.chunk_size
+        super().__init__(game, game_data, object_list, span, span)
+
+        # window 왼쪽 위 chunk 의 월드 chunk 좌표
+        self.origin_x = self.origin_y = -self.chunk_radius
+        # 메모리에서 내린 chunk 의 탐험 정보 (zlib) 와 죽거나 사용된 spawn id
+        self.evicted = dict()
+        self.removed = set()
+        # 내린 chunk 에 있던 몬스터, 월드 chunk -> {spawn id: (문자, 월드 x, 월드 y, hp)}
+        # 다른 chunk 에서 옮겨 온 몬스터도 있던 chunk 를 다시 불러올 때 그 자리에 복원
+        self.parked = dict()
+        # 내려둔 몬스터의 spawn id (생성된 chunk 에서 다시 만들지 않음)
+        self.parked_ids = set()
+
+        random = Random('{}:goal'.format(seed))
+        distance = game_data['chunk']['goal_distance']
+        goal_x = random.randint(-distance, distance)
+        self.goal_chunk = (goal_x, (distance - abs(goal_x)) * random.choice((-1, 1)))
+
+        for cx, cy in self._window_chunks(self.origin_x, self.origin_y):
+            self._load_chunk(cx, cy)
+
+    def _window_chunks(self, origin_x, origin_y):
+        span = 2 * self.chunk_radius + 1
+        return [(origin_x + dx, origin_y + dy) for dy in range(span) for dx in range(span)]
+
+    def _gate(self, kind, cx, cy):
+        # 두 chunk 가 공유하는 경계의 통로 위치
+        return Random('{}:{}:{}:{}'.format(self.seed, kind, cx, cy)).randint(1, self.chunk_size - 2)
+
+    def _generate_chunk(self, cx, cy):
+        size = self.chunk_size
+        random = Random('{}:{}:{}'.format(self.seed, cx, cy))
+
+        chunk = Dungeon(None, self.game_data, list(), size, size)
+        chunk.max_features = self.game_data['chunk']['features']
+        chunk.generate_map(random)
+
+        # 서쪽, 동쪽, 북쪽, 남쪽 경계의 통로에서 안쪽 바닥까지 연결
+        chunk.carve_to_floor(0, self._gate('v', cx, cy), 1, 0)
+        chunk.carve_to_floor(size - 1, self._gate('v', cx + 1, cy), -1, 0)
+        chunk.carve_to_floor(self._gate('h', cx, cy), 0, 0, 1)
+        chunk.carve_to_floor(self._gate('h', cx, cy + 1), size - 1, 0, -1)
+
+        # 일반 맵과 같은 밀도로 몬스터, 아이템 배치
+        floors = chunk.floor_cells()
+        ratio = size * size / (self.game_data['dungeon']['width'] * self.game_data['dungeon']['height'])
+        spawns = list()
+        for k, v in self.game_data['entries'].items():
+            if k in self.game_data['monsters']:
+                kind = 'monster'
+            elif k in self.game_data['items']:
+                kind = 'item'
+            else:
+                continue
+
+            for _ in range(int(v * ratio + random.random())):
+                i = random.choice(floors)
+                spawns.append((kind, k, i % size, i // size))
+
+        if (cx, cy) == self.goal_chunk:
+            i = random.choice(floors)
+            spawns.append(('goal', 'G', i % size, i // size))
+
+        return chunk.blocked, spawns
+
+    def _chunk_rows(self, cx, cy):
+        # window 안에서 chunk 의 각 행이 시작하는 index
+        size = self.chunk_size
+        left = (cx - self.origin_x) * size
+        top = (cy - self.origin_y) * size
+        return [(top + y) * self.map_width + left for y in range(size)]
+
+    def _load_chunk(self, cx, cy):
+        size = self.chunk_size
+        blocked, spawns = self._generate_chunk(cx, cy)
+        explored = self.evicted.pop((cx, cy), None)
+        explored = zlib.decompress(explored) if explored is not None else None
+
+        for y, start in enumerate(self._chunk_rows(cx, cy)):
+            self.blocked[start:start + size] = blocked[y * size:(y + 1) * size]
+            if explored is not None:
+                self.explored[start:start + size] = explored[y * size:(y + 1) * size]
+
+        # 이미 window 안에 있거나 없어졌거나 내려둔 오브젝트는 다시 만들지 않음
+        alive = {game_object.spawn_id for game_object in self.object_list}
+        left = (cx - self.origin_x) * size
+        top = (cy - self.origin_y) * size
+        for n, (kind, k, x, y) in enumerate(spawns):
+            spawn_id = (cx, cy, n)
+            if spawn_id in self.removed or spawn_id in alive or spawn_id in self.parked_ids:
+                continue
+
+            if kind == 'monster':
+                game_object = Monster(self.game, left + x, top + y, k, self.game_data['monsters'][k], self)
+            elif kind == 'item':
+                game_object = Item(self.game, left + x, top + y, k, self.game_data['items'][k], self)
+            else:
+                game_object = Goal(self.game, left + x, top + y, self)
+            game_object.spawn_id = spawn_id
+            self.add_object(game_object)
+
+        for spawn_id, (k, x, y, hp) in self.parked.pop((cx, cy), dict()).items():
+            self.parked_ids.discard(spawn_id)
+            game_object = Monster(self.game, x - self.origin_x * size, y - self.origin_y * size, k,
+                                  self.game_data['monsters'][k], self)
+            game_object.hp = hp
+            game_object.spawn_id = spawn_id
+            self.add_object(game_object)
+
+        self.version += 1
+
+    def _evict_chunk(self, cx, cy):
+        size = self.chunk_size
+        explored = b''.join(self.explored[start:start + size] for start in self._chunk_rows(cx, cy))
+        if any(explored):
+            self.evicted[(cx, cy)] = zlib.compress(explored)
+
+        # chunk 안의 오브젝트는 내림, 아이템과 goal 은 다음에 생성될 때 다시 배치
+        # 몬스터는 다른 chunk 에서 왔을 수 있으므로 위치와 hp 를 이 chunk 에 보관
+        left = (cx - self.origin_x) * size
+        top = (cy - self.origin_y) * size
+        parked = dict()
+        for game_object in list(self.object_list):
+            if left <= game_object.x < left + size and top <= game_object.y < top + size:
+                if game_object in self.monsters and game_object.spawn_id is not None:
+                    parked[game_object.spawn_id] = (game_object.char, game_object.x + self.origin_x * size,
+                                                    game_object.y + self.origin_y * size, game_object.hp)
+                    self.parked_ids.add(game_object.spawn_id)
+                Dungeon.remove_object(self, game_object)
+        if parked:
+            self.parked[(cx, cy)] = parked
+
+    def remove_object(self, game_object):
+        super().remove_object(game_object)
+        if game_object.spawn_id is not None:
+            self.removed.add(game_object.spawn_id)
+
+    def spawn_point(self):
+        # 중앙 chunk 의 바닥 중 하나
+        size = self.chunk_size
+        cx, cy = self.origin_x + self.chunk_radius, self.origin_y + self.chunk_radius
+        floors = [(start % self.map_width + x, start // self.map_width)
+                  for start in self._chunk_rows(cx, cy)
+                  for x in range(size) if self.blocked[start + x] == TILE_FLOOR]
+        return Random('{}:player'.format(self.seed)).choice(floors)
+
+    def _recenter(self, dx, dy):
+        # window 를 (dx, dy) chunk 만큼 이동, 겹치는 chunk 는 복사하고 나머지는 생성
+        size = self.chunk_size
+        old_chunks = self._window_chunks(self.origin_x, self.origin_y)
+        new_chunks = self._window_chunks(self.origin_x + dx, self.origin_y + dy)
+
+        for chunk in old_chunks:
+            if chunk not in new_chunks:
+                self._evict_chunk(*chunk)
+
+        shift = dy * size * self.map_width + dx * size
+        blocked = bytearray(len(self.blocked))
+        explored = bytearray(len(self.explored))
+        for chunk in old_chunks:
+            if chunk in new_chunks:
+                for start in self._chunk_rows(*chunk):
+                    blocked[start - shift:start - shift + size] = self.blocked[start:start + size]
+                    explored[start - shift:start - shift + size] = self.explored[start:start + size]
+
+        self.blocked = blocked
+        self.explored = explored
+        self.light = array('I', [0]) * len(blocked)
+        self.origin_x += dx
+        self.origin_y += dy
+
+        # 오브젝트 좌표 이동 후 위치 인덱스 재구성
+        self.occupancy = dict()
+        self.monster_buckets = dict()
+        for game_object in self.object_list:
+            game_object.x -= dx * size
+            game_object.y -= dy * size
+            self._occupy(game_object)
+            if game_object in self.monsters:
+                self.monster_buckets.setdefault(self._bucket(game_object), dict())[game_object] = None
+
+        # 남은 몬스터는 같은 객체이므로 scheduler 의 행동 시각을 그대로 사용 (내린 몬스터는 remove_object 에서 제외됨)
+        for chunk in new_chunks:
+            if chunk not in old_chunks:
+                self._load_chunk(*chunk)
+
+        self.version += 1
+        self._fov_key = None
+        self._fov_cache.clear()
+        self._visible = set()
+        self._dirty = None
+
+    def follow(self, game_object):
+        size = self.chunk_size
+        dx = game_object.x // size - self.chunk_radius
+        dy = game_object.y // size - self.chunk_radius
+        if dx or dy:
+            self._recenter(dx, dy)
+        super().follow(game_object)
+
+
+class DungeonLayout:
+    # pack 형식: header (seed, width, height, rooms, spawn 수, 맵 크기)
+    # + zlib 압축한 blocked + spawn (종류, 문자, x, y)
+    _header = struct.Struct('<qHHIHI')
+    _spawn = struct.Struct('<BcHH')
+    _kinds = ('monster', 'item', 'player', 'goal')
+
+    def __init__(self, seed, width, height, blocked, spawns, rooms=0):
+        # 여러 게임이 공유하므로 변경 불가능한 형태로 저장
+        self.seed = seed
+        self.width = width
+        self.height = height
+        self.blocked = bytes(blocked)
+        self.spawns = tuple(spawns)
+        self.rooms = rooms
+
+    def pack(self):
+        blocked = zlib.compress(self.blocked)
+        parts = [self._header.pack(self.seed, self.width, self.height, self.rooms, len(self.spawns), len(blocked)),
+                 blocked]
+        for kind, char, x, y in self.spawns:
+            parts.append(self._spawn.pack(self._kinds.index(kind), char.encode(), x, y))
+        return b''.join(parts)
+
+    @classmethod
+    def unpack(cls, data):
+        seed, width, height, rooms, num_spawns, size = cls._header.unpack_from(data)
+        offset = cls._header.size
+        blocked = zlib.decompress(data[offset:offset + size])
+        offset += size
+
+        spawns = list()
+        for _ in range(num_spawns):
+            kind, char, x, y = cls._spawn.unpack_from(data, offset)
+            spawns.append((cls._kinds[kind], char.decode(), x, y))
+            offset += cls._spawn.size
+
+        return cls(seed, width, height, blocked, spawns, rooms)
+
+    def start(self):
+        # 플레이어 시작 위치
+        for kind, _, x, y in self.spawns:
+            if kind == 'player':
+                return x, y
+
+
+class LevelDiff:
+    # LRU 에서 밀려난 층, seed 로 만든 layout 에서 달라진 오브젝트와 탐험한 칸만 보관
+    def __init__(self, seed, removed, changed, explored, now=0, times=None):
+        self.seed = seed
+        # 없어진 spawn 번호
+        self.removed = frozenset(removed)
+        # spawn 번호 -> 몬스터의 (x, y, hp)
+        self.changed = changed
+        # zlib 압축한 explored
+        self.explored = explored
+        # TurnScheduler 의 현재 시각과 spawn 번호 -> 다음 행동 시각
+        self.now = now
+        self.times = times or dict()
+
+    # pack 형식: header (seed, 시각, 없어진 수, 바뀐 수, 행동 예약 수, explored 크기)
+    #            + 없어진 번호 + 바뀐 몬스터 + 행동 예약 + explored
+    _header = struct.Struct('<qIHHHI')
+    _changed = struct.Struct('<HHHi')
+    _time = struct.Struct('<HI')
+
+    def pack(self):
+        parts = [self._header.pack(self.seed, self.now, len(self.removed), len(self.changed), len(self.times),
+                                   len(self.explored)),
+                 struct.pack('<{}H'.format(len(self.removed)), *sorted(self.removed))]
+        for n, (x, y, hp) in sorted(self.changed.items()):
+            parts.append(self._changed.pack(n, x, y, hp))
+        for n, time in sorted(self.times.items()):
+            parts.append(self._time.pack(n, time))
+        parts.append(self.explored)
+        return b''.join(parts)
+
+    @classmethod
+    def unpack(cls, data, offset=0):
+        # (LevelDiff, 다음 offset)
+        seed, now, num_removed, num_changed, num_times, size = cls._header.unpack_from(data, offset)
+        offset += cls._header.size
+        removed = struct.unpack_from('<{}H'.format(num_removed), data, offset)
+        offset += 2 * num_removed
+
+        changed = dict()
+        for _ in range(num_changed):
+            n, x, y, hp = cls._changed.unpack_from(data, offset)
+            changed[n] = (x, y, hp)
+            offset += cls._changed.size
+
+        times = dict()
+        for _ in range(num_times):
+            n, time = cls._time.unpack_from(data, offset)
+            times[n] = time
+            offset += cls._time.size
+
+        explored = bytes(data[offset:offset + size])
+        return cls(seed, removed, changed, explored, now, times), offset + size
+
+
+def parse_seed(text):
+    # /seed/<seed>, 저장 형식 (signed 64 bit) 에 들어가지 않거나 음수 (예전 형식에서 옮긴 층) 면 ValueError
+    seed = int(text)
+    if not 0 <= seed < 2 ** 63:
+        raise ValueError('seed out of range: {}'.format(seed))
+    return seed
+
+
+def level_seed(seed, depth):
+    # 첫 층은 seed 그대로 (DungeonPool, /seed/<seed> 와 같은 맵), 아래층은 (seed, depth) 로 결정
+    if depth == 0:
+        return seed
+    return Random('{}:{}'.format(seed, depth)).getrandbits(32)
+
+
+def build_layout(game_data, seed=None, max_attempts=10):
+    # 맵 생성과 (종류, 문자, x, y) 배치 목록, 같은 seed 면 같은 결과
+    if seed is None:
+        seed = Random().getrandbits(32)
+    random = Random(seed)
+
+    for _ in range(max_attempts):
+        dungeon = Dungeon(None, game_data, list())
+        dungeon.generate_map(random)
+        floors = dungeon.floor_cells()
+        if not floors:
+            continue
+
+        spawns = list()
+
+        # 몬스터, 아이템 배치
+        for k, v in game_data['entries'].items():
+            if k in game_data['monsters']:
+                kind = 'monster'
+            elif k in game_data['items']:
+                kind = 'item'
+            else:
+                continue
+
+            for _ in range(v):
+                i = random.choice(floors)
+                spawns.append((kind, k, i % dungeon.map_width, i // dungeon.map_width))
+
+        # 플레이어 배치
+        i = random.choice(floors)
+        player_x, player_y = i % dungeon.map_width, i // dungeon.map_width
+        for k in game_data['characters']:
+            spawns.append(('player', k, player_x, player_y))
+
+        # 탈출구는 플레이어로부터 길 찾기 거리가 goal_distance 이상인 칸 (직선 1칸 = cost 2)
+        field = dungeon.distance_field(player_x, player_y)
+        min_distance = game_data['dungeon']['goal_distance'] * 2
+        goals = [i for i in floors if min_distance <= field[i] != PATH_UNREACHABLE]
+        if not goals:
+            # 조건을 만족하는 칸이 없으면 다시 생성
+            continue
+
+        i = random.choice(goals)
+        spawns.append(('goal', 'G', i % dungeon.map_width, i // dungeon.map_width))
+
+        return DungeonLayout(seed, dungeon.map_width, dungeon.map_height, dungeon.blocked, spawns, dungeon.rooms)
+
+    raise RuntimeError('could not build a dungeon with a reachable goal (seed {})'.format(seed))
+
+
+def write_blob(f, data):
+    # DungeonLayout.pack() 결과를 길이와 함께 기록
+    f.write(struct.pack('<I', len(data)))
+    f.write(data)
+
+
+def read_layouts(path):
+    with open(path, 'rb') as f:
+        while True:
+            size = f.read(4)
+            if not size:
+                break
+            yield DungeonLayout.unpack(f.read(struct.unpack('<I', size)[0]))
+
+
+class DungeonPool:
+    def __init__(self, game_data, size=8, cache_size=32):
+        self.game_data = game_data
+        # 랜덤 seed 맵은 백그라운드에서 미리 생성
+        self._ready = queue.Queue(maxsize=size)
+        # 지정된 seed 맵은 LRU 캐시
+        self._cache = OrderedDict()
+        # prefetch 요청받은 seed (다음 층)
+        self._wanted = queue.Queue()
+        self._cache_size = cache_size
+        # 미리 검증해 둔 seed 맵 (캐시에서 밀려나지 않음)
+        self._preloaded = dict()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+
+    def preload(self, path):
+        # dungeon_batch.py --blobs 로 만든 파일
+        for layout in read_layouts(path):
+            self._preloaded[layout.seed] = layout
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _fill(self):
+        while self._running:
+            # 요청받은 seed 를 먼저 만들고, 없으면 랜덤 seed 맵을 채움
+            try:
+                seed = self._wanted.get(timeout=1) if self._ready.full() else self._wanted.get_nowait()
+            except queue.Empty:
+                seed = None
+
+            # 만들지 못한 seed 는 건너뜀 (요청 thread 에서 다시 시도)
+            try:
+                if seed is None:
+                    # 이 thread 만 채우므로 가득 차 있지 않으면 put 은 기다리지 않음
+                    if not self._ready.full():
+                        self._ready.put(build_layout(self.game_data))
+                    continue
+
+                with self._lock:
+                    cached = seed in self._cache
+                if not cached and seed not in self._preloaded:
+                    self._store(build_layout(self.game_data, seed))
+            except Exception:
+                logger.exception('dungeon pool failed to build seed %s', seed)
+
+    def _store(self, layout):
+        with self._lock:
+            self._cache[layout.seed] = layout
+            self._cache.move_to_end(layout.seed)
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    def prefetch(self, seed):
+        # 곧 필요한 seed 맵을 백그라운드에서 미리 생성
+        self._wanted.put(seed)
+
+    def get(self, seed=None):
+        if seed is None:
+            try:
+                return self._ready.get_nowait()
+            except queue.Empty:
+                return build_layout(self.game_data)
+
+        layout = self._preloaded.get(seed)
+        if layout is not None:
+            return layout
+
+        with self._lock:
+            layout = self._cache.get(seed)
+            if layout is not None:
+                self._cache.move_to_end(seed)
+                return layout
+
+        layout = build_layout(self.game_data, seed)
+        self._store(layout)
+        return layout
 
 
 class TextArea:
@@ -595,40 +1488,108 @@ class TextArea:
 
 
 class Game:
-    def __init__(self, game_data, user_name, save_handler=None, random_seed=None):
+    # save 형식: magic, flag + (zlib 압축할 수 있는) body
+    _save_magic = b'RGS\x00'
+    SAVE_COMPRESSED = 1
+    # seed 와 입력 기록만 저장, load 때 다시 실행
+    SAVE_REPLAY = 2
+    # /seed/<seed> 로 seed 를 지정한 게임 (다시 시작해도 같은 seed)
+    SAVE_FIXED_SEED = 4
+
+    # seed, 층, 스케줄러 시각, 이름 길이
+    _save_game = struct.Struct('<qHIH')
+    # 문자, hp, max_hp, power, defence, sight, turn, end, 색
+    _save_player = struct.Struct('<ciiiiiIB3B')
+    # 종류, flag (1: 위층 계단, 2: 스케줄됨), 문자, spawn 번호, x, y, hp, 행동 시각
+    _save_entity = struct.Struct('<BBcHHHiI')
+    _no_spawn_id = 0xFFFF
+
+    def __init__(self, game_data, user_name, save_handler=None, random_seed=None, dungeon_pool=None):
+        self._setup(game_data, user_name, save_handler, random_seed, dungeon_pool)
+        self._player, self._object_list, self._dungeon = self.initialize()
+
+    def _setup(self, game_data, user_name, save_handler, random_seed, dungeon_pool):
         self.game_data = game_data
 
         self._buffer = [[(' ', (0, 0, 0)) for _ in range(screen_width)] for _ in range(screen_height)]
+        # render_delta 로 클라이언트에 마지막으로 보낸 프레임
+        self._sent_buffer = None
+        self._frame_seq = 0
+        self._palette = build_palette(game_data)
 
         # UI 생성
         self.text_area = TextArea(self, 0, 42)
         self.status_bar = TextArea(self, 0, 40, 1)
         self.save_handler = save_handler
         self.random_seed = random_seed
+        self.dungeon_pool = dungeon_pool
         self.user_name = user_name
-        self._player, self._object_list, self._dungeon = self.initialize()
 
     def draw_char(self, x, y, char, color):
         self._buffer[y][x] = (char, color)
 
-    def turn(self):
+    def turn(self, delta=False):
         # game loop
+        self._dungeon.follow(self._player)
         while True:
             self._dungeon.do_fov(self._player.x, self._player.y, self._player.sight)
-            key_event = yield self.render()
+            key_event = yield self.render_delta() if delta else self.render()
+            if self.step(key_event):
+                break
+
+    def step(self, key_event):
+        # 입력 하나를 처리, 게임을 끝내면 True
+        if self._player.is_end():
+            self._player, self._object_list, self._dungeon = self.initialize()
+            self._dungeon.follow(self._player)
+            self._dungeon.do_fov(self._player.x, self._player.y, self._player.sight)
+            self.text_area.clear()
+
+        if self._inputs is not None and key_event in _replay_keys:
+            self._inputs.append(key_event.value)
 
-            if self._player.is_end():
-                self._player, self._object_list, self._dungeon = self.initialize()
-                self.text_area.clear()
+        exit_game = self.handle_keys(self._player, key_event)
+        if exit_game:
+            return True
+
+        self._dungeon.follow(self._player)
+        self._run_monsters()
+
+    def _run_monsters(self):
+        # 플레이어 행동 시간만큼 시계를 진행하고, 그 사이 행동할 몬스터를 시간 순으로 실행
+        dungeon = self._dungeon
+        scheduler = dungeon.scheduler
+        player = self._player
+        radius_squared = dungeon.wake_radius ** 2
 
-            exit_game = self.handle_keys(self._player, key_event)
-            if exit_game:
+        scheduler.now += TURN_TIME
+
+        # 주변에서 새로 깨어난 몬스터 등록
+        for monster in dungeon.get_active_monsters(player.x, player.y, dungeon.wake_radius):
+            if monster not in scheduler:
+                scheduler.schedule(monster, scheduler.now, dungeon.monsters[monster])
+
+        while True:
+            due = scheduler.pop_due()
+            if due is None:
                 break
 
-            for monster in self._dungeon.get_monsters():
-                monster.take_turn()
+            time, order, monster = due
+            # 멀어진 몬스터는 다시 깨어날 때까지 잠듦
+            if (monster.x - player.x) ** 2 + (monster.y - player.y) ** 2 > radius_squared:
+                continue
 
-    def render(self,):
+            monster.take_turn()
+            if monster in dungeon.monsters:
+                scheduler.schedule(monster, time + monster.action_time, order)
+
+    def _color_str(self, color):
+        color_str = self._palette.get(color)
+        if color_str is None:
+            color_str = self._palette[color] = color_to_str(color)
+        return color_str
+
+    def _compose(self):
         self._dungeon.draw()
 
         for obj in self._object_list:
@@ -638,20 +1599,69 @@ class Game:
         self.status_bar.draw()
         self.text_area.draw()
 
-        raw_text = str()
-        for line in self._buffer:
-            for letter, color in line:
-                if color != (0, 0, 0):
-                    color_str = ''.join(format(e, '02X') for e in color)
-                    raw_text += '[[;#{};]{}]'.format(color_str, letter)
-                else:
-                    raw_text += letter
-            raw_text += '\n'
-
+    def _clear_objects(self):
         for obj in self._object_list:
             obj.clear()
 
-        return raw_text
+    def render(self,):
+        self._compose()
+
+        # 같은 색이 연속된 글자는 하나의 span 으로 묶음
+        lines = list()
+        for line in self._buffer:
+            parts = list()
+            for color, cells in itertools.groupby(line, key=itemgetter(1)):
+                text = escape_brackets(''.join(letter for letter, _ in cells))
+                color_str = self._color_str(color)
+                parts.append('[[;#{};]{}]'.format(color_str, text) if color_str else text)
+            parts.append('\n')
+            lines.append(''.join(parts))
+
+        self._clear_objects()
+
+        return ''.join(lines)
+
+    def render_delta(self, full=False):
+        # 마지막으로 보낸 프레임과 달라진 칸만 [y, x, text, color] run 으로 반환
+        # full 이면 빈 화면 기준으로 비교 (로그인, 재동기화)
+        self._compose()
+
+        if full or self._sent_buffer is None:
+            full = True
+            sent_buffer = [[(' ', (0, 0, 0))] * screen_width for _ in range(screen_height)]
+        else:
+            sent_buffer = self._sent_buffer
+
+        runs = list()
+        for y, (line, sent_line) in enumerate(zip(self._buffer, sent_buffer)):
+            if line == sent_line:
+                continue
+
+            x = 0
+            while x < screen_width:
+                if line[x] == sent_line[x]:
+                    x += 1
+                    continue
+
+                start = x
+                color = line[x][1]
+                letters = list()
+                while x < screen_width and line[x] != sent_line[x] and line[x][1] == color:
+                    letters.append(line[x][0])
+                    x += 1
+
+                runs.append([y, start, ''.join(letters), self._color_str(color)])
+
+        self._sent_buffer = [list(line) for line in self._buffer]
+        self._clear_objects()
+
+        # delta 는 seq - 1 프레임 기준, 클라이언트는 seq 가 건너뛰면 전체 프레임을 다시 요청
+        self._frame_seq += 1
+        return {'full': full, 'seq': self._frame_seq, 'runs': runs}
+
+    def reset_delta(self):
+        # 클라이언트 화면을 알 수 없을 때 (다시 불러온 게임), 다음 render_delta 는 전체 프레임
+        self._sent_buffer = None
 
     def handle_keys(self, player, key_event):
         if key_event is KeyCode.esc:
@@ -669,74 +1679,354 @@ class Game:
         if key_event is KeyCode.right:
             player.move(1, 0)
 
-    def _distance_to(self, obj, x, y):
-        dx = obj.x - x
-        dy = obj.y - y
-        return math.sqrt(dx ** 2 + dy ** 2)
-
     def initialize(self):
-        random = Random(self.random_seed)
+        self.depth = 0
+        # 이번 게임의 방향키 입력 (KeyCode 값), SAVE_REPLAY 에 사용
+        self._inputs = bytearray()
+        if self.game_data['dungeon']['chunked']:
+            return self._initialize_chunked()
+
+        # 최근에 방문한 층 (depth -> (object_list, dungeon)), 밀려난 층은 LevelDiff 로 보관
+        self._levels = OrderedDict()
+        self._level_diffs = dict()
+
+        layout = self._get_layout(self.random_seed)
+        self.seed = layout.seed
+        self._prefetch_level()
+        _object_list, _dungeon = self._build_level(layout)
+
+        x, y = layout.start()
+        for k, v in self.game_data['characters'].items():
+            _player = Player(self, x, y, k, v, _dungeon, self.user_name)
+            _dungeon.add_object(_player)
 
-        # 던전 생성 및 맵 자동 생성
-        _object_list = list()
-        _dungeon = Dungeon(self, self.game_data, _object_list)
-        _dungeon.generate_map(random)
+        return _player, _object_list, _dungeon
 
-        # 몬스터, 아이템 생성 및 배치
-        for k, v in self.game_data['entries'].items():
-            if k in self.game_data['monsters']:
-                monster_data = self.game_data['monsters'][k]
+    def _get_layout(self, seed):
+        if self.dungeon_pool is not None:
+            return self.dungeon_pool.get(seed)
+        return build_layout(self.game_data, seed)
 
-                num_monsters = v
-                while num_monsters > 0:
-                    x = random.randint(0, _dungeon.map_width - 1)
-                    y = random.randint(0, _dungeon.map_height - 1)
-                    if not _dungeon.is_block(x, y):
-                        monster = Monster(self, x, y, k, monster_data, _dungeon)
-                        _object_list.append(monster)
-                        num_monsters -= 1
+    def _build_level(self, layout, level_diff=None):
+        # 미리 만든 맵을 복사하고 배치 정보대로 오브젝트 생성 (플레이어 제외)
+        _object_list = list()
+        _dungeon = Dungeon(self, self.game_data, _object_list)
+        _dungeon.load_layout(layout)
+
+        removed = level_diff.removed if level_diff is not None else ()
+        changed = level_diff.changed if level_diff is not None else dict()
+
+        for n, (kind, k, x, y) in enumerate(layout.spawns):
+            if n in removed:
+                continue
+            if kind == 'monster':
+                game_object = Monster(self, x, y, k, self.game_data['monsters'][k], _dungeon)
+                if n in changed:
+                    game_object.x, game_object.y, game_object.hp = changed[n]
+            elif kind == 'item':
+                game_object = Item(self, x, y, k, self.game_data['items'][k], _dungeon)
+            elif kind == 'goal':
+                game_object = Goal(self, x, y, _dungeon)
+            else:
+                continue
+            game_object.spawn_id = n
+            _dungeon.add_object(game_object)
+
+        if self.depth > 0:
+            # 시작 위치에 위층으로 가는 계단
+            x, y = layout.start()
+            _dungeon.add_object(Goal(self, x, y, _dungeon, up=True))
+
+        if level_diff is not None:
+            _dungeon.explored[:] = zlib.decompress(level_diff.explored)
+            # 몬스터 행동 순서도 밀려나기 전과 같게
+            _dungeon.scheduler.now = level_diff.now
+            for game_object in _object_list:
+                if game_object.spawn_id in level_diff.times:
+                    _dungeon.scheduler.schedule(game_object, level_diff.times[game_object.spawn_id],
+                                                _dungeon.monsters[game_object])
+
+        return _object_list, _dungeon
+
+    def is_last_level(self):
+        # 예전 형식에서 옮긴 층 (seed 가 -1, seed 로 다시 만들 수 없음) 은 예전처럼 탈출하면 끝
+        # score (턴 수) 는 모든 층의 합이라 levels 를 바꾸면 예전 기록과 비교할 수 없음, 기본은 예전처럼 한 층
+        return (self.game_data['dungeon']['chunked'] or self.depth + 1 >= self.game_data['dungeon'].get('levels', 1)
+                or self.seed < 0)
+
+    def change_level(self, delta):
+        # 플레이어를 delta 만큼 아래(+)/위(-) 층으로 옮김
+        player = self._player
+        self._dungeon.remove_object(player)
+        self._levels[self.depth] = (self._object_list, self._dungeon)
+        self._levels.move_to_end(self.depth)
+        while len(self._levels) > self.game_data['dungeon']['level_cache']:
+            depth, (_, dungeon) = self._levels.popitem(last=False)
+            self._level_diffs[depth] = dungeon.diff_layout()
+
+        self.depth += delta
+        if self.depth in self._levels:
+            self._object_list, self._dungeon = self._levels.pop(self.depth)
+        else:
+            # 처음 가는 층은 seed 로 생성, 밀려났던 층은 LevelDiff 를 적용해서 다시 만듦
+            level_diff = self._level_diffs.pop(self.depth, None)
+            layout = self._get_layout(level_diff.seed if level_diff else level_seed(self.seed, self.depth))
+            self._object_list, self._dungeon = self._build_level(layout, level_diff)
+
+        # 내려가면 시작 위치 (위층 계단), 올라가면 아래층으로 가는 탈출구
+        if delta > 0:
+            x, y = self._dungeon.layout.start()
+        else:
+            goal = self._dungeon.get_goal()
+            x, y = goal.x, goal.y
 
-            elif k in self.game_data['items']:
-                item_data = self.game_data['items'][k]
+        player.x, player.y = x, y
+        player.dungeon = self._dungeon
+        self._dungeon.add_object(player)
+        # 이전 층이 그려진 화면을 전부 다시 그림
+        self._dungeon._dirty = None
+        self._prefetch_level()
 
-                num_items = v
-                while num_items > 0:
-                    x = random.randint(0, _dungeon.map_width - 1)
-                    y = random.randint(0, _dungeon.map_height - 1)
-                    if not _dungeon.is_block(x, y):
-                        monster = Item(self, x, y, k, item_data, _dungeon)
-                        _object_list.append(monster)
-                        num_items -= 1
+    def _prefetch_level(self):
+        # 아래층 맵을 미리 만들어 둠
+        if self.dungeon_pool is not None and not self.is_last_level():
+            self.dungeon_pool.prefetch(level_seed(self.seed, self.depth + 1))
 
-        # 플레이어 배치
-        while True:
-            x = random.randint(0, _dungeon.map_width - 1)
-            y = random.randint(0, _dungeon.map_height - 1)
-            if not _dungeon.is_block(x, y):
-                for k, v in self.game_data['characters'].items():
-                    _player = Player(self, x, y, k, self.game_data['characters'][k], _dungeon, self.user_name)
-                    _object_list.append(_player)
-                break
+    def _initialize_chunked(self):
+        seed = self.random_seed if self.random_seed is not None else Random().getrandbits(32)
+        self.seed = seed
 
-        # 탈출구 배치
-        while True:
-            x = random.randint(0, _dungeon.map_width - 1)
-            y = random.randint(0, _dungeon.map_height - 1)
-            distance = self._distance_to(_player, x, y)
-            if not _dungeon.is_block(x, y) and distance >= self.game_data['dungeon']['goal_distance']:
-                _object_list.append(Goal(self, x, y, _dungeon))
-                break
+        _object_list = list()
+        _dungeon = ChunkedDungeon(self, self.game_data, _object_list, seed)
+        x, y = _dungeon.spawn_point()
+        for k, v in self.game_data['characters'].items():
+            _player = Player(self, x, y, k, v, _dungeon, self.user_name)
+            _dungeon.add_object(_player)
 
         return _player, _object_list, _dungeon
 
     def save(self):
+        # users.map_data 는 예전처럼 base64 text (TEXT 컬럼 그대로 사용), 세션 파일은 dumps 그대로
         if self.save_handler:
-            game_data = pickle.dumps(self)
-            b64_game_data = base64.b64encode(game_data)
-            self.save_handler(self._player.name, self._player.turn_count, b64_game_data)
+            self.save_handler(self._player.name, self._player.turn_count, base64.b64encode(self.dumps()).decode())
+
+    def dumps(self):
+        # chunk 맵은 현재 창만으로는 복원할 수 없으므로 항상 입력 기록으로 저장
+        save_data = self.game_data['save']
+        replay = save_data['replay'] or self.game_data['dungeon']['chunked']
+        if replay and self._inputs is None:
+            # snapshot 에서 불러온 게임은 입력 기록이 없음
+            replay = False
+
+        flags = self.SAVE_FIXED_SEED if self.random_seed is not None else 0
+        if replay:
+            flags |= self.SAVE_REPLAY
+            body = self._dump_replay()
+        else:
+            body = self._dump_snapshot()
+
+        if save_data['compress']:
+            flags |= self.SAVE_COMPRESSED
+            body = zlib.compress(body)
+
+        return self._save_magic + bytes((flags,)) + body
+
+    def _dump_name(self):
+        name = self.user_name.encode()
+        return self._save_game.pack(self.seed, self.depth, self._dungeon.scheduler.now, len(name)) + name
+
+    def _dump_replay(self):
+        # 방향키 하나를 2 bit 로
+        inputs = self._inputs
+        packed = bytearray((len(inputs) + 3) // 4)
+        for i, key in enumerate(inputs):
+            packed[i >> 2] |= key << ((i & 3) << 1)
+        return b''.join((self._dump_name(), struct.pack('<I', len(inputs)), packed))
+
+    def _dump_snapshot(self):
+        dungeon = self._dungeon
+        player = self._player
+        parts = [self._dump_name(), self._save_player.pack(
+            player.char.encode(), player.hp, player.max_hp, player.power, player.defence, player.sight,
+            player.turn_count, player.end, *player.color
+        )]
+
+        # 현재 층: layout, explored, 오브젝트 (object_list 순서)
+        layout = dungeon.layout.pack()
+        explored = zlib.compress(dungeon.explored)
+        parts += [struct.pack('<I', len(layout)), layout, struct.pack('<I', len(explored)), explored]
+
+        times = dungeon.scheduler.times()
+        parts.append(struct.pack('<H', len(dungeon.object_list)))
+        for game_object in dungeon.object_list:
+            kind = DungeonLayout._kinds.index(_save_kinds[type(game_object)])
+            flags = 0
+            if getattr(game_object, 'up', False):
+                flags |= 1
+            if game_object in times:
+                flags |= 2
+            spawn_id = game_object.spawn_id if game_object.spawn_id is not None else self._no_spawn_id
+            parts.append(self._save_entity.pack(
+                kind, flags, game_object.char.encode(), spawn_id, game_object.x, game_object.y,
+                getattr(game_object, 'hp', 0), times.get(game_object, 0)
+            ))
+
+        # 나머지 층은 LevelDiff 로
+        diffs = dict(self._level_diffs)
+        for depth, (_, level) in self._levels.items():
+            diffs[depth] = level.diff_layout()
+        parts.append(struct.pack('<H', len(diffs)))
+        for depth, level_diff in sorted(diffs.items()):
+            parts += [struct.pack('<H', depth), level_diff.pack()]
+
+        return b''.join(parts)
 
     @classmethod
-    def load(cls, b64_game_data):
-        game_data = base64.b64decode(b64_game_data)
-        game = pickle.loads(game_data)
+    def load(cls, data, game_data=None, save_handler=None, dungeon_pool=None):
+        # DB 의 map_data 는 base64, 예전 pickle 형식은 Game 전체가 들어있음
+        if isinstance(data, str):
+            data = data.encode()
+        if not data.startswith(cls._save_magic):
+            data = base64.b64decode(data)
+            if not data.startswith(cls._save_magic):
+                return cls._load_legacy(data, game_data, save_handler, dungeon_pool)
+
+        flags = data[len(cls._save_magic)]
+        body = data[len(cls._save_magic) + 1:]
+        if flags & cls.SAVE_COMPRESSED:
+            body = zlib.decompress(body)
+
+        seed, depth, now, size = cls._save_game.unpack_from(body)
+        offset = cls._save_game.size
+        user_name = bytes(body[offset:offset + size]).decode()
+        offset += size
+
+        game = cls.__new__(cls)
+        game._setup(game_data, user_name, save_handler, seed if flags & cls.SAVE_FIXED_SEED else None, dungeon_pool)
+        if flags & cls.SAVE_REPLAY:
+            game._load_replay(seed, body, offset)
+        else:
+            game._load_snapshot(seed, depth, now, body, offset)
         return game
+
+    @classmethod
+    def _load_legacy(cls, data, game_data, save_handler, dungeon_pool):
+        legacy = _LegacyUnpickler(io.BytesIO(data)).load()
+        legacy_dungeon = legacy._dungeon
+
+        game = cls.__new__(cls)
+        game._setup(game_data or legacy.game_data, legacy.user_name, save_handler, legacy.random_seed, dungeon_pool)
+        game.seed = -1
+        game.depth = 0
+        game._inputs = None
+        game._levels = OrderedDict()
+        game._level_diffs = dict()
+
+        # dungeon_map 의 Tile.blocked (None, False, True) 를 blocked 배열로, 오브젝트 위치는 spawn 으로
+        width, height = legacy_dungeon.map_width, legacy_dungeon.map_height
+        blocked = bytes(_tile_code[tile.blocked] for row in legacy_dungeon.dungeon_map for tile in row)
+        kinds = {'Player': 'player', 'Monster': 'monster', 'Item': 'item', 'Goal': 'goal'}
+        spawns = [(kinds[type(o).__name__], o.char, o.x, o.y) for o in legacy_dungeon.object_list]
+        layout = DungeonLayout(-1, width, height, blocked, spawns)
+
+        _object_list = list()
+        _dungeon = Dungeon(game, game.game_data, _object_list, width, height)
+        _dungeon.load_layout(layout)
+        for n, ((kind, k, x, y), o) in enumerate(zip(spawns, legacy_dungeon.object_list)):
+            if kind == 'monster':
+                game_object = Monster(game, x, y, k, game.game_data['monsters'][k], _dungeon)
+                game_object.hp = o.hp
+            elif kind == 'item':
+                game_object = Item(game, x, y, k, game.game_data['items'][k], _dungeon)
+            elif kind == 'goal':
+                game_object = Goal(game, x, y, _dungeon)
+            else:
+                game_object = _player = Player(game, x, y, k, game.game_data['characters'][k], _dungeon, o.name)
+                _player.hp, _player.max_hp, _player.power, _player.defence = o.hp, o.max_hp, o.power, o.defence
+                _player.sight, _player.turn_count, _player.end, _player.color = o.sight, o.turn_count, o.end, o.color
+            if kind != 'player':
+                game_object.spawn_id = n
+            _dungeon.add_object(game_object)
+
+        game.text_area.text_list = list(legacy.text_area.text_list)
+        _player.refresh_status_bar()
+        game._player, game._object_list, game._dungeon = _player, _object_list, _dungeon
+        return game
+
+    def _load_replay(self, seed, body, offset):
+        (count,) = struct.unpack_from('<I', body, offset)
+        packed = body[offset + 4:offset + 4 + (count + 3) // 4]
+
+        # 같은 seed 로 시작해서 입력을 순서대로 다시 실행 (turn 과 같은 순서)
+        # 이미 저장된 기록을 다시 저장하지 않도록 실행하는 동안 save_handler 는 끔
+        random_seed, save_handler = self.random_seed, self.save_handler
+        self.random_seed, self.save_handler = seed, None
+        try:
+            self._player, self._object_list, self._dungeon = self.initialize()
+            self.random_seed = random_seed
+            self._dungeon.follow(self._player)
+            for i in range(count):
+                self._dungeon.do_fov(self._player.x, self._player.y, self._player.sight)
+                self.step(KeyCode((packed[i >> 2] >> ((i & 3) << 1)) & 3))
+            self._dungeon.do_fov(self._player.x, self._player.y, self._player.sight)
+        finally:
+            self.random_seed, self.save_handler = random_seed, save_handler
+
+    def _load_snapshot(self, seed, depth, now, body, offset):
+        self.seed = seed
+        self.depth = depth
+        self._inputs = None
+
+        stats = self._save_player.unpack_from(body, offset)
+        offset += self._save_player.size
+
+        (size,) = struct.unpack_from('<I', body, offset)
+        layout = DungeonLayout.unpack(body[offset + 4:offset + 4 + size])
+        offset += 4 + size
+        (size,) = struct.unpack_from('<I', body, offset)
+        explored = zlib.decompress(body[offset + 4:offset + 4 + size])
+        offset += 4 + size
+
+        _object_list = list()
+        _dungeon = Dungeon(self, self.game_data, _object_list)
+        _dungeon.load_layout(layout)
+        _dungeon.explored[:] = explored
+        _dungeon.scheduler.now = now
+
+        (count,) = struct.unpack_from('<H', body, offset)
+        offset += 2
+        for _ in range(count):
+            kind, flags, k, spawn_id, x, y, hp, time = self._save_entity.unpack_from(body, offset)
+            offset += self._save_entity.size
+            kind, k = DungeonLayout._kinds[kind], k.decode()
+
+            if kind == 'monster':
+                game_object = Monster(self, x, y, k, self.game_data['monsters'][k], _dungeon)
+                game_object.hp = hp
+            elif kind == 'item':
+                game_object = Item(self, x, y, k, self.game_data['items'][k], _dungeon)
+            elif kind == 'goal':
+                game_object = Goal(self, x, y, _dungeon, up=bool(flags & 1))
+            else:
+                game_object = _player = Player(self, x, y, k, self.game_data['characters'][k], _dungeon,
+                                               self.user_name)
+            if spawn_id != self._no_spawn_id:
+                game_object.spawn_id = spawn_id
+            _dungeon.add_object(game_object)
+            if flags & 2:
+                _dungeon.scheduler.schedule(game_object, time, _dungeon.monsters[game_object])
+
+        _player.char = stats[0].decode()
+        _player.hp, _player.max_hp, _player.power, _player.defence, _player.sight = stats[1:6]
+        _player.turn_count, _player.end, _player.color = stats[6], bool(stats[7]), tuple(stats[8:])
+        _player.refresh_status_bar()
+
+        self._levels = OrderedDict()
+        self._level_diffs = dict()
+        (count,) = struct.unpack_from('<H', body, offset)
+        offset += 2
+        for _ in range(count):
+            (level,) = struct.unpack_from('<H', body, offset)
+            self._level_diffs[level], offset = LevelDiff.unpack(body, offset + 2)
+
+        self._player, self._object_list, self._dungeon = _player, _object_list, _dungeon
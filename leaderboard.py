@@ -0,0 +1,86 @@
+import bisect
+import threading
+
+# 순위를 DB 대신 메모리에서 정렬해서 유지, 기록은 writer (SaveWriter) 로 그대로 전달
+# ex) board = Leaderboard(save_writer); board.load(connect); board.put(user_name, score, map_data); board.top()
+
+
+def dots(string, length):
+    return (string[:length] + '..') if len(string) > length else string
+
+
+class Leaderboard:
+    def __init__(self, writer=None, size=10):
+        self.writer = writer
+        self.size = size
+        # user_name -> 정렬 key (score, -기록 순서, user_name)
+        self._keys = dict()
+        # 모든 사용자의 key, DB 의 ORDER BY score, last_login DESC 와 같은 순서
+        self._ranking = list()
+        self._clock = 0
+        # 상위 size 명이 바뀔 때만 증가 (/high_rank 의 ETag)
+        self.version = 0
+        self._top = None
+        self._lock = threading.Lock()
+
+    def load(self, connect):
+        # 시작할 때 한 번만 DB 에서 읽음
+        connection = connect()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT user_name, score FROM users WHERE score IS NOT NULL ORDER BY score, last_login DESC')
+            rows = cursor.fetchall()
+            cursor.close()
+        finally:
+            connection.close()
+
+        with self._lock:
+            # 먼저 나온 (최근) 기록일수록 큰 순서, 이후 기록은 그보다 큰 순서
+            self._clock = len(rows)
+            self._keys = {row[0]: (row[1], i - len(rows), row[0]) for i, row in enumerate(rows)}
+            self._ranking = sorted(self._keys.values())
+            self._top = None
+            self.version += 1
+
+    def put(self, user_name, score, map_data):
+        # save_callback 에서 호출, DB 처럼 더 좋은 점수만 남기고 기록 순서는 항상 갱신
+        with self._lock:
+            changed = False
+            best = score
+            key = self._keys.get(user_name)
+            if key is not None:
+                index = bisect.bisect_left(self._ranking, key)
+                del self._ranking[index]
+                changed = index < self.size
+                best = min(score, key[0])
+
+            self._clock += 1
+            key = (best, -self._clock, user_name)
+            self._keys[user_name] = key
+            index = bisect.bisect_left(self._ranking, key)
+            self._ranking.insert(index, key)
+
+            if changed or index < self.size:
+                self._top = None
+                self.version += 1
+
+        if self.writer is not None:
+            self.writer.put(user_name, score, map_data)
+
+    def top(self):
+        # (version, [[이름, 점수], ...])
+        with self._lock:
+            if self._top is None:
+                self._top = [[dots(key[2], 8), key[0]] for key in self._ranking[:self.size]]
+            return self.version, self._top
+
+    def get(self):
+        return self.top()[1]
+
+    def rank(self, user_name):
+        # 1 부터, 기록이 없으면 None
+        with self._lock:
+            key = self._keys.get(user_name)
+            if key is None:
+                return None
+            return bisect.bisect_left(self._ranking, key) + 1
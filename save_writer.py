@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+
+# Game.save 결과를 요청 thread 에서 바로 쓰지 않고 백그라운드에서 모아서 기록
+# ex) writer = SaveWriter(mysql.connect); writer.start(); writer.put(user_name, score, map_data)
+
+logger = logging.getLogger(__name__)
+
+# score 는 턴 수 (작을수록 좋음), 더 좋은 기록일 때만 map_data 를 바꿈
+# MySQL 은 SET 을 왼쪽부터 적용하므로 map_data 를 score 보다 먼저 갱신
+_upsert = {
+    'mysql': (
+        'INSERT INTO `users` (`user_name`, `score`, `map_data`) VALUES {} '
+        'ON DUPLICATE KEY UPDATE map_data = IF(score > VALUES(score), VALUES(map_data), map_data), '
+        'score = LEAST(score, VALUES(score)), last_login = now()',
+        '(%s, %s, %s)'
+    ),
+    'sqlite': (
+        'INSERT INTO users (user_name, score, map_data) VALUES {} '
+        'ON CONFLICT(user_name) DO UPDATE SET '
+        'map_data = CASE WHEN score > excluded.score THEN excluded.map_data ELSE map_data END, '
+        'score = MIN(score, excluded.score), last_login = CURRENT_TIMESTAMP',
+        '(?, ?, ?)'
+    ),
+}
+
+
+class SaveWriter:
+    def __init__(self, connect, dialect='mysql', batch_size=100, interval=0.5, retries=3, retry_delay=0.1):
+        # connect: writer thread 에서 사용할 DB-API connection 을 만드는 함수
+        self.connect = connect
+        self.dialect = dialect
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        # user_name -> (score, map_data), 사용자별로 가장 좋은 기록 하나만 남김
+        self._pending = dict()
+        self._writing = 0
+        self._condition = threading.Condition()
+        self._connection = None
+        self._thread = None
+        self._running = False
+
+    def put(self, user_name, score, map_data):
+        with self._condition:
+            self._merge(user_name, score, map_data)
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify_all()
+
+    def _merge(self, user_name, score, map_data):
+        # 같은 점수면 DB 처럼 먼저 들어온 기록을 유지
+        pending = self._pending.get(user_name)
+        if pending is None or score < pending[0]:
+            self._pending[user_name] = (score, map_data)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def flush(self, timeout=None):
+        # 지금까지 put 된 기록을 모두 쓸 때까지 대기, 시간 안에 못 쓰면 False
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._condition.notify_all()
+            while (self._pending or self._writing) and self._thread is not None:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return not self._pending
+
+    def close(self, timeout=None):
+        # 종료 hook: 남은 기록을 쓰고 thread 종료
+        flushed = self.flush(timeout)
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        return flushed
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._running and not self._pending:
+                    self._condition.wait(self.interval)
+                if not self._running and not self._pending:
+                    break
+                rows = [(k, v[0], v[1]) for k, v in self._pending.items()]
+                self._pending = dict()
+                self._writing = len(rows)
+
+            failed = list()
+            for i in range(0, len(rows), self.batch_size):
+                batch = rows[i:i + self.batch_size]
+                if not self._write(batch):
+                    failed += self._write_rows(batch)
+
+            with self._condition:
+                # 실패한 기록은 그 사이 들어온 기록과 합쳐서 다음에 다시 시도
+                for row in failed:
+                    self._merge(*row)
+                self._writing = 0
+                self._condition.notify_all()
+
+            if failed:
+                time.sleep(self.interval)
+
+    def _write_rows(self, rows):
+        # 묶음이 계속 실패하면 DB 가 살아 있을 때만 한 행씩 다시 써서 거부되는 행을 골라냄
+        # DB 에 연결되지 않으면 그대로 돌려주고 다음에 다시 시도
+        if not self._ping():
+            return rows
+        failed = [row for row in rows if not self._write([row], 0)]
+        if failed and self._ping():
+            # 혼자서도 실패하는 행은 다시 시도해도 실패하므로 버림 (남겨두면 이후 기록이 계속 막힘)
+            for row in failed:
+                logger.error('dropped save of %s (score %s)', row[0], row[1])
+            return []
+        return failed
+
+    def _ping(self):
+        try:
+            if self._connection is None:
+                self._connection = self.connect()
+            cursor = self._connection.cursor()
+            try:
+                cursor.execute('SELECT 1')
+                cursor.fetchall()
+            finally:
+                cursor.close()
+            return True
+        except Exception:
+            logger.exception('save database unreachable')
+            self._reset_connection()
+            return False
+
+    def _write(self, rows, retries=None):
+        if retries is None:
+            retries = self.retries
+        sql, values = _upsert[self.dialect]
+        sql = sql.format(', '.join([values] * len(rows)))
+        params = [value for row in rows for value in row]
+
+        for attempt in range(retries + 1):
+            try:
+                if self._connection is None:
+                    self._connection = self.connect()
+                cursor = self._connection.cursor()
+                try:
+                    cursor.execute(sql, params)
+                finally:
+                    cursor.close()
+                self._connection.commit()
+                return True
+            except Exception:
+                logger.exception('save failed (%d rows, attempt %d)', len(rows), attempt + 1)
+                self._reset_connection()
+                if attempt < retries:
+                    time.sleep(self.retry_delay * 2 ** attempt)
+        return False
+
+    def _reset_connection(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
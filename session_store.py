@@ -0,0 +1,304 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# game_session 대신 사용, 오래 입력이 없거나 너무 많으면 게임을 파일로 내렸다가 다음 요청 때 다시 불러옴
+# ex) store = SessionStore('sessions', dump, load, ttl=600, max_resident=1000); store.start()
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore:
+    def __init__(self, spill_dir, dump, load, ttl=600, max_resident=1000, spill_ttl=86400, interval=30):
+        # dump(value) -> bytes, 사용 중이라 내릴 수 없으면 None
+        # load(key, bytes) -> value
+        self.spill_dir = spill_dir
+        self.dump = dump
+        self.load = load
+        self.ttl = ttl
+        self.max_resident = max_resident
+        # 파일로 내린 뒤 spill_ttl 초 동안 돌아오지 않으면 삭제
+        self.spill_ttl = spill_ttl
+        self.interval = interval
+        # key -> (value, 마지막 사용 시각), 오래된 것부터
+        self._resident = OrderedDict()
+        # 파일로 내린 key -> 내린 시각
+        self._spilled = dict()
+        # 파일을 읽거나 쓰는 중인 key -> 끝나면 set 되는 Event
+        # 파일 I/O 와 load/dump 는 lock 밖에서 하고, 같은 key 를 쓰는 다른 thread 만 기다림
+        self._busy = dict()
+        self._lock = threading.RLock()
+        self._thread = None
+        self._stop = threading.Event()
+
+        # 이전 실행의 세션은 쿠키와 함께 무효
+        os.makedirs(spill_dir, exist_ok=True)
+        for name in os.listdir(spill_dir):
+            if name.endswith('.sav'):
+                os.remove(os.path.join(spill_dir, name))
+
+    def _path(self, key):
+        return os.path.join(self.spill_dir, hashlib.sha1(key.encode()).hexdigest() + '.sav')
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._resident or key in self._spilled or key in self._busy
+
+    def __len__(self):
+        with self._lock:
+            return len(self._resident.keys() | self._spilled.keys() | self._busy.keys())
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        while True:
+            with self._lock:
+                busy = self._busy.get(key)
+                if busy is None:
+                    self._discard_spilled(key)
+                    self._resident[key] = (value, time.monotonic())
+                    self._resident.move_to_end(key)
+                    break
+            busy.wait()
+        self._evict_over_cap()
+
+    def get(self, key, default=None):
+        # 사용할 때마다 마지막 사용 시각 갱신, 파일로 내린 것은 다시 불러옴
+        while True:
+            with self._lock:
+                entry = self._resident.get(key)
+                if entry is not None:
+                    # 내리는 중이어도 그대로 반환, dump 로 닫힌 value 는 다시 get 하면 파일에서 불러옴
+                    value = entry[0]
+                    self._resident[key] = (value, time.monotonic())
+                    self._resident.move_to_end(key)
+                    break
+                busy = self._busy.get(key)
+                if busy is None:
+                    if key not in self._spilled:
+                        return default
+                    busy = self._busy[key] = threading.Event()
+                    break
+            busy.wait()
+
+        if entry is None:
+            value = self._reload(key, busy)
+        self._evict_over_cap()
+        return value
+
+    def _reload(self, key, busy):
+        # busy 를 등록한 key 를 lock 밖에서 파일에서 불러옴
+        value = None
+        try:
+            with open(self._path(key), 'rb') as f:
+                value = self.load(key, f.read())
+        finally:
+            with self._lock:
+                del self._busy[key]
+                busy.set()
+                if value is not None:
+                    self._discard_spilled(key)
+                    self._resident[key] = (value, time.monotonic())
+        return value
+
+    def pop(self, key, default=None):
+        while True:
+            with self._lock:
+                busy = self._busy.get(key)
+                if busy is None:
+                    entry = self._resident.pop(key, None)
+                    if entry is not None:
+                        return entry[0]
+                    if key in self._spilled:
+                        self._discard_spilled(key)
+                        return None
+                    return default
+            busy.wait()
+
+    def _discard_spilled(self, key):
+        if self._spilled.pop(key, None) is not None:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _spill(self, key, ttl=None):
+        # lock 밖에서 호출, ttl 이 있으면 그 사이 다시 사용된 세션은 내리지 않음
+        with self._lock:
+            entry = self._resident.get(key)
+            if entry is None or key in self._busy:
+                return False
+            if ttl is not None and time.monotonic() - entry[1] < ttl:
+                return False
+            busy = self._busy[key] = threading.Event()
+
+        value, last_activity = entry
+        try:
+            try:
+                data = self.dump(value)
+            except Exception:
+                # 내리지 못한 세션은 메모리에 그대로 두고 다음 세션 진행
+                logger.exception('failed to dump session %s', key)
+                return False
+            if data is None:
+                return False
+
+            # dump 한 value 는 닫혔으므로 파일에 쓰는 동안 get 은 busy 를 기다림
+            with self._lock:
+                del self._resident[key]
+            path = self._path(key)
+            try:
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(path + '.tmp', path)
+            except OSError:
+                # 파일에 쓰지 못하면 dump 결과로 다시 만듦
+                logger.exception('failed to spill session %s', key)
+                try:
+                    value = self.load(key, data)
+                except Exception:
+                    logger.exception('failed to reload session %s', key)
+                    return False
+                with self._lock:
+                    self._resident[key] = (value, last_activity)
+                return False
+
+            with self._lock:
+                self._spilled[key] = time.monotonic()
+            return True
+        finally:
+            with self._lock:
+                del self._busy[key]
+                busy.set()
+
+    def _evict_over_cap(self):
+        # 가장 오래 사용하지 않은 것부터, 사용 중인 것은 건너뜀 (lock 밖에서 호출)
+        with self._lock:
+            if len(self._resident) <= self.max_resident:
+                return
+            keys = list(self._resident)
+        for key in keys:
+            with self._lock:
+                if len(self._resident) <= self.max_resident:
+                    break
+            self._spill(key)
+
+    def evict_idle(self):
+        # ttl 이 지난 세션을 파일로, spill_ttl 이 지난 파일은 삭제, (내린 수, 삭제한 수)
+        now = time.monotonic()
+        with self._lock:
+            idle = list()
+            for key, (_, last_activity) in self._resident.items():
+                if now - last_activity < self.ttl:
+                    break
+                idle.append(key)
+
+            expired = [key for key, spill_time in self._spilled.items()
+                       if now - spill_time >= self.spill_ttl and key not in self._busy]
+            for key in expired:
+                self._discard_spilled(key)
+
+        spilled = sum(1 for key in idle if self._spill(key, self.ttl))
+        return spilled, len(expired)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.evict_idle()
+            except Exception:
+                logger.exception('session eviction failed')
+
+
+class GameSessions(SessionStore):
+    # user_name -> 게임 세션, web.py 와 async_web.py 가 같이 사용
+    # 게임 세션 (web.ThreadSafeIter, async_web.GameSession) 은 game, start(), try_lock(), unlock(), close() 를 가짐
+    # ex) store = GameSessions('sessions', load_game, GameSession, **server_data['session'])
+    def __init__(self, spill_dir, load_game, new_session, **kwargs):
+        # load_game(bytes) -> Game, new_session(game) -> 게임 세션
+        super().__init__(spill_dir, self._dump_session, self._load_session, **kwargs)
+        self.load_game = load_game
+        self.new_session = new_session
+
+    @staticmethod
+    def _dump_session(game_session):
+        # 처리 중인 요청이 있으면 내리지 않음
+        if not game_session.try_lock():
+            return None
+        try:
+            # dumps 가 실패하면 닫지 않고 그대로 사용
+            data = game_session.game.dumps()
+            game_session.close()
+            return data
+        finally:
+            game_session.unlock()
+
+    def _load_session(self, user_name, data):
+        game = self.load_game(data)
+        game_session = self.new_session(game)
+        game_session.start()
+        # 내리기 전 메시지는 저장하지 않으므로 다음 응답은 전체 프레임
+        game.reset_delta()
+        return game_session
+
+
+class CookieSessions:
+    # 쿠키의 session id -> 세션 값, ttl 동안 사용하지 않으면 삭제 (web.py 와 async_web.py 가 같이 사용)
+    # ex) sessions = CookieSessions(86400); sessions.put(sid, value); sessions.get(sid)
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # session id -> (값, 마지막 사용 시각), 오래된 것부터
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, sid):
+        with self._lock:
+            return sid in self._sessions
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def get(self, sid):
+        # 사용할 때마다 마지막 사용 시각 갱신, 없거나 지났으면 None
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._sessions.get(sid)
+            if entry is None:
+                return None
+            self._sessions[sid] = (entry[0], now)
+            self._sessions.move_to_end(sid)
+            return entry[0]
+
+    def put(self, sid, value):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            self._sessions[sid] = (value, now)
+            self._sessions.move_to_end(sid)
+
+    def _expire(self, now):
+        # 게임도 spill_ttl 이 지나면 지워지므로 같이 정리
+        while self._sessions:
+            sid, (_, last_access) = next(iter(self._sessions.items()))
+            if now - last_access < self.ttl:
+                break
+            del self._sessions[sid]
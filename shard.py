@@ -0,0 +1,217 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import struct
+import tempfile
+import zlib
+from async_web import AsyncGameServer, RankCache, connector, start_game_host, stop_game_host
+from game import KeyCode
+
+# 세션을 user_name 으로 나눠서 여러 worker process 가 게임을 진행, front process 는 HTTP 와 routing 만
+# ex) python shard.py --workers 8 --port 80
+
+# worker 와 front 사이 메시지: (요청 번호, 길이) + body
+# 요청 body 는 JSON {'op', 'user_name', ...}, 응답 body 는 프레임 JSON (게임이 없으면 빈 bytes)
+_message = struct.Struct('<II')
+
+logger = logging.getLogger(__name__)
+
+
+async def read_message(reader):
+    request_id, size = _message.unpack(await reader.readexactly(_message.size))
+    return request_id, await reader.readexactly(size)
+
+
+def write_message(writer, request_id, body):
+    writer.write(_message.pack(request_id, len(body)) + body)
+
+
+def shard_index(user_name, num_workers):
+    # process 마다 달라지는 hash() 대신 crc32
+    return zlib.crc32(user_name.encode()) % num_workers
+
+
+class ShardWorker:
+    # front 의 요청을 GameHost 에 전달
+    def __init__(self, host):
+        self.host = host
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_id, body = await read_message(reader)
+                # 같은 사용자의 요청은 GameSession queue 에 받은 순서대로 들어감
+                asyncio.ensure_future(self._handle(writer, request_id, json.loads(body)))
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # 종료할 때 취소된 연결은 조용히 닫음
+            pass
+        finally:
+            writer.close()
+
+    async def _handle(self, writer, request_id, request):
+        op = request['op']
+        user_name = request['user_name']
+        try:
+            if op == 'start_game':
+                frame = await self.host.start_game(user_name, request['random_seed'])
+            elif op == 'resync':
+                frame = await self.host.resync(user_name)
+            elif op == 'command':
+                frame = await self.host.command(user_name, KeyCode(request['key']))
+            else:
+                frame = await self.host.end_game(user_name)
+        except Exception:
+            # front 가 기다리지 않도록 응답은 항상 보냄
+            logger.exception('%s failed for %s', op, user_name)
+            frame = None
+
+        write_message(writer, request_id, json.dumps(frame).encode() if frame is not None else b'')
+
+
+class WorkerClient:
+    # worker 하나와의 연결, 응답은 요청 번호로 찾음
+    def __init__(self, path):
+        self.path = path
+        self._reader = None
+        self._writer = None
+        self._futures = dict()
+        self._next_id = 0
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        async with self._lock:
+            if self._writer is None:
+                self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+                asyncio.ensure_future(self._read_responses())
+
+    async def _read_responses(self):
+        try:
+            while True:
+                request_id, body = await read_message(self._reader)
+                future = self._futures.pop(request_id)
+                if not future.done():
+                    future.set_result(body or None)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            self._writer = None
+            for future in self._futures.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('shard worker closed: {}'.format(e)))
+            self._futures = dict()
+
+    async def call(self, op, user_name, **kwargs):
+        if self._writer is None:
+            await self._connect()
+
+        request_id = self._next_id
+        self._next_id = (self._next_id + 1) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        self._futures[request_id] = future
+        kwargs.update(op=op, user_name=user_name)
+        write_message(self._writer, request_id, json.dumps(kwargs).encode())
+        return await future
+
+
+class ShardRouter:
+    # async_web.GameHost 와 같은 method, user_name 을 가진 worker 로 전달
+    def __init__(self, paths):
+        self.workers = [WorkerClient(path) for path in paths]
+
+    def _worker(self, user_name):
+        return self.workers[shard_index(user_name, len(self.workers))]
+
+    async def start_game(self, user_name, random_seed):
+        return await self._worker(user_name).call('start_game', user_name, random_seed=random_seed)
+
+    async def resync(self, user_name):
+        return await self._worker(user_name).call('resync', user_name)
+
+    async def command(self, user_name, key):
+        return await self._worker(user_name).call('command', user_name, key=key.value)
+
+    async def end_game(self, user_name):
+        await self._worker(user_name).call('end_game', user_name)
+
+
+def run_worker(index, path, data_path, sqlite_path, ready):
+    with open(data_path, 'r', encoding='utf-8') as f:
+        server_data = json.load(f)
+
+    connect, dialect = connector(server_data, sqlite_path)
+    host = start_game_host(server_data, connect, dialect, os.path.join('sessions', 'worker{}'.format(index)))
+    worker = ShardWorker(host)
+
+    async def serve():
+        # front 가 terminate 하면 남은 save 를 쓰고 종료
+        stop = asyncio.get_running_loop().create_future()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set_result, None)
+        asyncio.ensure_future(host.evict_idle_sessions())
+        async with await asyncio.start_unix_server(worker.handle_connection, path):
+            ready.set()
+            await stop
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_game_host(host)
+
+
+def start_workers(num_workers, data_path, sqlite_path=None, socket_dir=None):
+    # (worker process 목록, socket 경로 목록)
+    socket_dir = socket_dir or tempfile.mkdtemp(prefix='rpg_shard_')
+    paths = [os.path.join(socket_dir, 'worker{}.sock'.format(i)) for i in range(num_workers)]
+    processes = list()
+    for index, path in enumerate(paths):
+        if os.path.exists(path):
+            os.remove(path)
+        ready = multiprocessing.Event()
+        process = multiprocessing.Process(target=run_worker, args=(index, path, data_path, sqlite_path, ready),
+                                          daemon=True)
+        process.start()
+        processes.append((process, ready))
+
+    for process, ready in processes:
+        while not ready.wait(1):
+            if not process.is_alive():
+                raise RuntimeError('shard worker exited with code {}'.format(process.exitcode))
+    return [process for process, _ in processes], paths
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=80)
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--data', default='game_data.json')
+    parser.add_argument('--sqlite', default=None, help='use a local SQLite file instead of MySQL')
+    parser.add_argument('--socket-dir', default=None)
+    args = parser.parse_args()
+
+    processes, paths = start_workers(args.workers, args.data, args.sqlite, args.socket_dir)
+
+    with open(args.data, 'r', encoding='utf-8') as f:
+        server_data = json.load(f)
+    connect, _ = connector(server_data, args.sqlite)
+    server = AsyncGameServer(ShardRouter(paths), RankCache(connect), server_data['session']['spill_ttl'])
+
+    async def serve():
+        async with await asyncio.start_server(server.handle_connection, args.host, args.port) as s:
+            await s.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# shard.py 를 worker 수를 바꿔가며 띄우고 여러 client process 로 /login + /command 를 보내서 처리량 측정
+# ex) python shard_bench.py --workers 1 2 4 8 --clients 400 --moves 50
+
+
+class Client:
+    # keep-alive 연결 하나, 쿠키로 세션 유지
+    def __init__(self, port):
+        self.port = port
+        self.cookie = None
+        self.reader = None
+        self.writer = None
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+
+    async def post(self, path, form):
+        body = '&'.join('{}={}'.format(k, v) for k, v in form.items()).encode()
+        head = 'POST {} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {}\r\n'.format(path, len(body))
+        if self.cookie:
+            head += 'Cookie: session={}\r\n'.format(self.cookie)
+        self.writer.write(head.encode() + b'\r\n' + body)
+        await self.writer.drain()
+
+        lines = (await self.reader.readuntil(b'\r\n\r\n')).decode().split('\r\n')
+        headers = dict(line.split(': ', 1) for line in lines[1:] if ': ' in line)
+        if 'Set-Cookie' in headers:
+            self.cookie = headers['Set-Cookie'].split(';')[0].split('=', 1)[1]
+        return await self.reader.readexactly(int(headers['Content-Length']))
+
+
+async def play(port, name, moves, latencies):
+    client = Client(port)
+    await client.open()
+    await client.post('/login', {'user_name': name})
+    random_moves = random.Random(name)
+    for _ in range(moves):
+        start = time.perf_counter()
+        await client.post('/command', {'direction': random_moves.choice(('37', '38', '39', '40'))})
+        latencies.append(time.perf_counter() - start)
+    client.writer.close()
+
+
+def run_clients(port, names, moves, result):
+    latencies = list()
+
+    async def run():
+        await asyncio.gather(*(play(port, name, moves, latencies) for name in names))
+
+    start = time.time()
+    asyncio.run(run())
+    result.put((start, time.time(), latencies))
+
+
+def wait_port(port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('server did not start')
+
+
+def bench(workers, clients, moves, client_procs, port, data):
+    temp_dir = tempfile.mkdtemp(prefix='rpg_bench_')
+    server = subprocess.Popen([sys.executable, 'shard.py', '--workers', str(workers), '--port', str(port),
+                               '--host', '127.0.0.1', '--data', data, '--sqlite', os.path.join(temp_dir, 'users.db'),
+                               '--socket-dir', temp_dir])
+    try:
+        wait_port(port)
+        # DungeonPool 이 채워질 때까지 잠시 대기
+        time.sleep(3)
+
+        result = multiprocessing.Queue()
+        names = ['bench{}'.format(i) for i in range(clients)]
+        processes = [multiprocessing.Process(target=run_clients, args=(port, names[i::client_procs], moves, result))
+                     for i in range(client_procs)]
+        for process in processes:
+            process.start()
+        results = [result.get() for _ in processes]
+        for process in processes:
+            process.join()
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait()
+        shutil.rmtree(temp_dir)
+
+    start = min(r[0] for r in results)
+    end = max(r[1] for r in results)
+    latencies = sorted(latency for r in results for latency in r[2])
+    return {
+        'workers': workers,
+        'clients': clients,
+        'moves_per_sec': round(len(latencies) / (end - start), 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('-c', '--clients', type=int, default=400)
+    parser.add_argument('-m', '--moves', type=int, default=50)
+    parser.add_argument('--client-procs', type=int, default=2)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--data', default='game_data.json')
+    args = parser.parse_args()
+
+    for workers in args.workers:
+        sys.stdout.write(json.dumps(bench(workers, args.clients, args.moves, args.client_procs, args.port, args.data)) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
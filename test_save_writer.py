@@ -0,0 +1,132 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from save_writer import SaveWriter
+
+# SaveWriter 를 SQLite 로 확인
+# ex) python -m unittest test_save_writer
+
+
+class SaveWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'users.db')
+        connection = sqlite3.connect(self.path)
+        # 너무 긴 이름은 DB 가 거부
+        connection.execute('CREATE TABLE users (user_name TEXT PRIMARY KEY CHECK (length(user_name) <= 8), '
+                           'score INTEGER, map_data TEXT, last_login TIMESTAMP DEFAULT CURRENT_TIMESTAMP)')
+        connection.commit()
+        connection.close()
+        self.executed = list()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def connect(self):
+        test = self
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+
+        class Cursor:
+            def __init__(self):
+                self.cursor = connection.cursor()
+
+            def execute(self, sql, params=()):
+                test.executed.append(sql)
+                return self.cursor.execute(sql, params)
+
+            def fetchall(self):
+                return self.cursor.fetchall()
+
+            def close(self):
+                self.cursor.close()
+
+        class Connection:
+            def cursor(self):
+                return Cursor()
+
+            def commit(self):
+                connection.commit()
+
+            def close(self):
+                connection.close()
+
+        return Connection()
+
+    def writer(self, **kwargs):
+        return SaveWriter(self.connect, 'sqlite', interval=0.01, retry_delay=0.01, **kwargs)
+
+    def rows(self):
+        connection = sqlite3.connect(self.path)
+        try:
+            return {row[0]: (row[1], row[2]) for row in connection.execute('SELECT user_name, score, map_data FROM users')}
+        finally:
+            connection.close()
+
+    def upserts(self):
+        return [sql for sql in self.executed if sql.startswith('INSERT')]
+
+    def test_merge_keeps_best_score(self):
+        writer = self.writer()
+        writer.put('alice', 30, b'a30')
+        writer.put('alice', 10, b'a10')
+        writer.put('alice', 20, b'a20')
+        writer.put('alice', 10, b'a10 later')
+        writer.start()
+        self.assertTrue(writer.close(5))
+        self.assertEqual(self.rows(), {'alice': (10, b'a10')})
+        self.assertEqual(len(self.upserts()), 1)
+
+    def test_keep_better_score_in_database(self):
+        writer = self.writer()
+        writer.start()
+        writer.put('alice', 10, b'a10')
+        self.assertTrue(writer.flush(5))
+        writer.put('alice', 20, b'a20')
+        self.assertTrue(writer.close(5))
+        self.assertEqual(self.rows(), {'alice': (10, b'a10')})
+
+    def test_batch(self):
+        writer = self.writer(batch_size=2)
+        for i in range(5):
+            writer.put('u{}'.format(i), i, b'')
+        writer.start()
+        self.assertTrue(writer.close(5))
+        self.assertEqual(len(self.rows()), 5)
+        self.assertEqual(len(self.upserts()), 3)
+
+    def test_drop_rejected_row(self):
+        writer = self.writer()
+        writer.put('alice', 10, b'a')
+        writer.put('too long name', 20, b'x')
+        writer.put('bob', 30, b'b')
+        writer.start()
+        self.assertTrue(writer.flush(5))
+        self.assertEqual(self.rows(), {'alice': (10, b'a'), 'bob': (30, b'b')})
+
+        # 이후 기록도 계속 쓰임
+        writer.put('carol', 40, b'c')
+        self.assertTrue(writer.close(5))
+        self.assertIn('carol', self.rows())
+
+    def test_retry_when_database_unreachable(self):
+        attempts = [3]
+        connect = self.connect
+
+        def flaky_connect():
+            if attempts[0] > 0:
+                attempts[0] -= 1
+                raise sqlite3.OperationalError('unable to open database file')
+            return connect()
+
+        writer = SaveWriter(flaky_connect, 'sqlite', interval=0.01, retries=1, retry_delay=0.01)
+        writer.put('alice', 10, b'a')
+        writer.start()
+        self.assertTrue(writer.close(5))
+        self.assertEqual(self.rows(), {'alice': (10, b'a')})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,19 +1,67 @@
+import atexit
 import json
 import os
-import datetime
+import secrets
 import threading
 from flask import Flask, session, request, send_from_directory, jsonify
-from flask.ext.mysql import MySQL
-from game import KeyCode, Game
+from flaskext.mysql import MySQL
+from flask.sessions import SessionInterface, SessionMixin
+from flask_sock import Sock
+from werkzeug.datastructures import CallbackDict
+from game import KeyCode, Game, DungeonPool, parse_seed
+from leaderboard import Leaderboard
+from save_writer import SaveWriter
+from session_store import GameSessions, CookieSessions
 
 
 app = Flask(__name__)
+sock = Sock(app)
 
 # 게임 데이터 로드
 with open('game_data.json', 'r', encoding='utf-8') as f:
     server_data = json.load(f)
 
-game_session = dict()
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, sid, initial=None):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.modified = False
+
+
+class ServerSessionInterface(SessionInterface):
+    # 세션 값은 서버에 두고 쿠키에는 session id 만 (async_web.AsyncGameServer 와 같은 CookieSessions)
+    def __init__(self, ttl):
+        self.sessions = CookieSessions(ttl)
+
+    def open_session(self, app, request):
+        session = self.sessions.get(request.cookies.get(app.config['SESSION_COOKIE_NAME']))
+        if session is None:
+            session = ServerSession(secrets.token_urlsafe(16))
+        return session
+
+    def save_session(self, app, session, response):
+        # 값이 생긴 새 세션만 저장하고 쿠키 발급, 이후 요청은 쿠키가 바뀌지 않음
+        if session.sid in self.sessions or not session:
+            return
+        self.sessions.put(session.sid, session)
+
+        response.set_cookie(app.config['SESSION_COOKIE_NAME'], session.sid,
+                            domain=self.get_cookie_domain(app), path=self.get_cookie_path(app),
+                            httponly=self.get_cookie_httponly(app), secure=self.get_cookie_secure(app))
+
+
+app.session_interface = ServerSessionInterface(server_data['session']['spill_ttl'])
+
+# 맵은 백그라운드에서 미리 생성
+dungeon_pool = DungeonPool(server_data)
+if os.path.exists('dungeon_blobs.bin'):
+    # dungeon_batch.py --blobs 로 미리 만든 이벤트용 seed 맵
+    dungeon_pool.preload('dungeon_blobs.bin')
+dungeon_pool.start()
 
 
 @app.route('/static/<path>')
@@ -34,12 +82,11 @@ def index():
 @app.route('/seed/<seed>')
 def take_random_seed(seed):
     try:
-        session['random_seed'] = int(seed)
+        session['random_seed'] = parse_seed(seed)
         if 'user_name' in session:
             user_name = session['user_name']
             game_session.pop(user_name)
             session.pop('user_name')
-            session.pop('map_data')
     except ValueError:
         session['random_seed'] = None
 
@@ -50,44 +97,97 @@ key_map = {'38': KeyCode.up, '40': KeyCode.down, '39': KeyCode.right, '37': KeyC
 
 
 def save_callback(player_name, player_turn_count, game_data):
-    with mysql.get_db().cursor() as cursor:
-        sql = 'INSERT INTO `users` (`user_name`, `score`, `map_data`) VALUES (%s, %s, %s)' \
-              'ON DUPLICATE KEY UPDATE score = IF(score > %s, %s, score), map_data = IF(score > %s, %s, map_data), last_login = now()'
-        cursor.execute(
-            sql, (
-                player_name, player_turn_count, game_data, player_turn_count, player_turn_count, player_turn_count, game_data
-            )
-        )
-
-    mysql.get_db().commit()
+    # 순위는 바로 갱신하고, DB 기록은 leaderboard 가 save_writer queue 에 넣어서 save_writer thread 에서
+    leaderboard.put(player_name, player_turn_count, game_data)
 
 
 class ThreadSafeIter:
-    def __init__(self, it):
+    def __init__(self, it, game=None):
         self.it = it
+        self.game = game
         self.lock = threading.Lock()
+        # 파일로 내린 뒤에는 None 을 반환, game_session 에서 다시 가져와야 함
+        self.closed = False
 
     def __iter__(self):
         return self
 
     def next(self, *args, **kwargs):
         with self.lock:
+            if self.closed:
+                return None
             return self.it.next(*args, **kwargs)
 
     def send(self, *args, **kwargs):
         with self.lock:
+            if self.closed:
+                return None
             return self.it.send(*args, **kwargs)
 
+    def resync(self):
+        with self.lock:
+            if self.closed:
+                return None
+            return self.game.render_delta(full=True)
+
+    def start(self):
+        # 첫 프레임
+        return self.send(None)
+
+    # GameSessions 가 파일로 내릴 때 사용, 다른 요청이 사용 중이면 내리지 않음
+    def try_lock(self):
+        return self.lock.acquire(blocking=False)
+
+    def unlock(self):
+        self.lock.release()
+
+    def close(self):
+        # try_lock 한 상태에서 호출
+        self.closed = True
+
+
+def game_context_of(game):
+    return ThreadSafeIter(game.turn(delta=True), game)
+
+
+def load_game(data):
+    return Game.load(data, server_data, save_callback, dungeon_pool)
+
+
+# 입력이 없는 게임은 파일로 내렸다가 다음 요청 때 다시 불러옴
+game_session = GameSessions('sessions', load_game, game_context_of, **server_data['session'])
+game_session.start()
+
+
+def send_key(user_name, key):
+    # 처리 도중 파일로 내려졌으면 다시 불러와서 처리
+    while True:
+        game_context = game_session.get(user_name)
+        if game_context is None:
+            return None
+        frame = game_context.send(key)
+        if frame is not None:
+            return frame
+
+
+def resync(user_name):
+    while True:
+        game_context = game_session.get(user_name)
+        if game_context is None:
+            return None
+        frame = game_context.resync()
+        if frame is not None:
+            return frame
+
 
 def init_user(user_name):
     random_seed = session.get('random_seed', None)
-    game = Game(server_data, user_name, save_callback, random_seed)
-    game_context = ThreadSafeIter(game.turn())
-    map_data = game_context.send(None)
+    game = Game(server_data, user_name, save_callback, random_seed, dungeon_pool)
+    game_context = game_context_of(game)
+    frame = game_context.start()
     game_session[user_name] = game_context
     session['user_name'] = user_name
-    session['map_data'] = map_data
-    return map_data
+    return jsonify(frame)
 
 
 @app.route('/login', methods=['POST'])
@@ -98,12 +198,14 @@ def login():
         return init_user(user_name)
     else:
         if session['user_name'] == user_name:
-            return session['map_data']
+            frame = resync(user_name)
+            if frame is None:
+                return init_user(user_name)
+            return jsonify(frame)
         else:
             session_user_name = session['user_name']
             game_session.pop(session_user_name)
             session.pop('user_name')
-            session.pop('map_data')
             return init_user(user_name)
 
 
@@ -115,43 +217,55 @@ def command():
         if 'user_name' not in session:
             return ''
 
-        user_name = session['user_name']
-        game_context = game_session[user_name]
-        map_data = game_context.send(key)
-        session['map_data'] = map_data
-        return map_data
+        frame = send_key(session['user_name'], key)
+        if frame is None:
+            return ''
+        return jsonify(frame)
     else:
         return ''
 
 
-class MySQLCache:
-    def __init__(self, mysql, refresh_tick=5):
-        self.refresh_tick = refresh_tick
-        self.mysql = mysql
-        self.last_access_time = datetime.datetime.min
-        self.result = None
-
-    def get(self):
-        def dots(string, length):
-            return (string[:length] + '..') if len(string) > length else string
+@sock.route('/ws')
+def websocket(ws):
+    # 연결 하나에 로그인한 사용자의 게임을 묶고, 받은 순서대로 키를 처리해서 프레임을 보냄
+    if 'user_name' not in session:
+        return
 
-        now = datetime.datetime.now()
+    user_name = session['user_name']
+    game_context = game_session.get(user_name)
+    if game_context is None:
+        return
 
-        if (now - self.last_access_time).seconds > self.refresh_tick:
-            with self.mysql.get_db().cursor() as cursor:
-                sql = 'SELECT user_name, score FROM users ORDER BY score, last_login DESC LIMIT 10'
-                cursor.execute(sql)
-                self.result = [[dots(i[0], 8), i[1]] for i in cursor.fetchall()]
+    # 연결 직후에는 전체 프레임
+    frame = game_context.resync()
+    while frame is not None:
+        ws.send(json.dumps(frame))
 
-            self.last_access_time = now
+        key = KeyCode.invalid
+        while key is KeyCode.invalid:
+            key = key_map.get(ws.receive(), KeyCode.invalid)
 
-        return self.result
+        frame = game_context.send(key) if game_session.get(user_name) is game_context else None
+        if frame is None:
+            # 파일로 내렸다가 다시 불러왔거나 다른 곳에서 다시 로그인해서 게임이 바뀌었어도 받은 키는 현재 게임에 보냄
+            # 게임이 없으면 연결을 끊음 (클라이언트는 POST 로 돌아감)
+            if send_key(user_name, key) is None:
+                return
+            # 바뀐 게임의 프레임 번호는 이어지지 않으므로 전체 프레임
+            game_context = game_session.get(user_name)
+            frame = resync(user_name)
 
 
 @app.route('/high_rank', methods=['POST'])
 def high_rank():
-    rank = db_cache.get()
-    return jsonify(rank=rank)
+    # 상위 순위가 바뀌지 않았으면 304, 서버를 다시 시작하면 ETag 도 바뀜
+    version, rank = leaderboard.top()
+    etag = '{}-{}'.format(rank_tag, version)
+    if request.if_none_match.contains(etag):
+        return '', 304
+    response = jsonify(rank=rank)
+    response.set_etag(etag)
+    return response
 
 app.config['MYSQL_DATABASE_USER'] = server_data['mysql']['user']
 app.config['MYSQL_DATABASE_PASSWORD'] = server_data['mysql']['password']
@@ -159,7 +273,13 @@ app.config['MYSQL_DATABASE_DB'] = server_data['mysql']['database']
 app.config['MYSQL_DATABASE_HOST'] = server_data['mysql']['host']
 app.config['MYSQL_DATABASE_PORT'] = server_data['mysql']['port']
 mysql = MySQL(app)
-db_cache = MySQLCache(mysql)
+save_writer = SaveWriter(mysql.connect)
+save_writer.start()
+# 순위는 시작할 때 한 번만 DB 에서 읽고 이후에는 메모리에서
+leaderboard = Leaderboard(save_writer)
+leaderboard.load(mysql.connect)
+rank_tag = secrets.token_hex(4)
+# 종료할 때 남은 기록을 씀
+atexit.register(save_writer.close, 10)
 
-app.secret_key = os.urandom(24)
 app.run(host='0.0.0.0', port=80, threaded=True)